@@ -8,7 +8,58 @@ from typing import Optional, Dict, List, Any
 from pathlib import Path
 from dotenv import load_dotenv
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+# Schemas of normalized metadata tables. Record batches produced by parse_*
+# functions share them, so batches of all titles can be concatenated with
+# pa.Table.from_batches without copying.
+ACTORS_SCHEMA = pa.schema([
+    ('title_id', pa.string()),
+    ('actor_id', pa.string()),
+    ('actor_name', pa.string()),
+    ('order_num', pa.int16())
+])
+RECOMMENDATIONS_SCHEMA = pa.schema([
+    ('title_id', pa.string()),
+    ('suggested_title_id', pa.string()),
+    ('order_num', pa.int16())
+])
+COUNTRIES_SCHEMA = pa.schema([
+    ('title_id', pa.string()),
+    ('country', pa.string()),
+    ('order_num', pa.int16())
+])
+COMPANIES_SCHEMA = pa.schema([
+    ('title_id', pa.string()),
+    ('company', pa.string()),
+    ('order_num', pa.int16())
+])
+# Captures entity identifier and its order number from IMDB links, e.g.
+# '/title/tt1345836/?ref_=tt_sims_tt_t_1' -> ('/title/tt1345836/', '1').
+# Links without order number give None in place of it.
+REF_PATTERN = re.compile(r'([^?]*)(?:\?(?:.*_(\d+)$)?)?')
+# IMDB abbreviates large numbers, e.g. '2.9K' or '1.2M'
+SHORT_FORMS = {
+    'K': 'e+03',
+    'M': 'e+06',
+    'B': 'e+09',
+    'T': 'e+12'
+}
+SHORT_FORM_PATTERN = re.compile('[KMBT]')
+# e.g. '1710 out of 1850 found this helpful.' -> ('1710', '1850')
+HELPFULNESS_PATTERN = r'(?P<upvotes>\d+)\D+(?P<total_votes>\d+)'
+# keeps strings in Arrow buffers when converting Arrow data to pandas
+ARROW_STRING_TYPES = {pa.string(): pd.StringDtype('pyarrow')}
+# with Copy-on-Write enabled transformations can chain .assign/.drop without
+# defensive copies of input data. It is enabled only while ETL runs, so
+# pandas behaves as usual for other code in the same process.
+COPY_ON_WRITE = ('mode.copy_on_write', True)
+# number of raw reviews transformed at once, small enough to fit in cache
+REVIEWS_BATCH_SIZE = 65536
 
 
 class ReviewsETL:
@@ -53,22 +104,35 @@ class ReviewsETL:
 
     @staticmethod
     def transform(raw_data: pd.DataFrame) -> pd.DataFrame:
-        transformed_data = (
-            raw_data
-            .pipe(split_helpfulness_col)
-            .pipe(correct_review_author)
-            .pipe(cut_off_review_title_newline)
-            .pipe(convert_to_date)
-            .pipe(change_review_dtypes)
-            .drop(['Unnamed: 0'], axis=1)
-        )
-        return transformed_data
+        """
+        Transforms raw reviews batch by batch, so each batch of Arrow arrays
+        goes through all transformation steps while it is still in cache.
+        """
+        for col in ['helpfulness', 'author', 'title', 'date', 'rating']:
+            if col not in raw_data.columns:
+                raise ValueError(f'No "{col}" column in input data')
+
+        with pd.option_context(*COPY_ON_WRITE):
+            table = pa.Table.from_pandas(raw_data, preserve_index=False)
+            batches = [
+                transform_review_batch(batch)
+                for batch in table.to_batches(REVIEWS_BATCH_SIZE)
+            ]
+            return (
+                pa.Table.from_batches(batches)
+                .to_pandas(types_mapper=ARROW_STRING_TYPES.get)
+            )
 
     def run(self):
+        with pd.option_context(*COPY_ON_WRITE):
+            self._run()
+
+    def _run(self):
         metadata = pd.read_json(
             self._metadata_file,
             storage_options=self._storage_options,
-            orient='index'
+            orient='index',
+            dtype_backend='pyarrow'
         )
         partition_to_titles = (
             metadata['original_title']
@@ -143,81 +207,72 @@ class MetadataETL:
     #     return details
 
 
-def normalize(df: pd.DataFrame, col: str) -> pd.DataFrame:
-    norm = pd.json_normalize(df[col])
-    norm.columns = norm.columns.astype(int)
-    return norm
-
-
-def split_helpfulness_col(df_raw: pd.DataFrame) -> pd.DataFrame:
+def flatten_struct(s: pd.Series) -> pd.DataFrame:
     """
-    Split 'helpfulness' column of input dataframe into two
-    distinct columns: 'upvotes' and 'total_votes'.
-    After transformation 'helpfulness' column is removed.
+    Flattens a column of dictionaries (or Arrow structs) into a DataFrame
+    with a column per key and a row per dictionary, numbered from 0 as
+    json_normalize does. Missing dictionaries result in rows of nulls.
     """
-    if 'helpfulness' not in df_raw.columns:
-        raise ValueError('No "helpfulness" column in input data')
-
-    df_ = df_raw.copy(deep=False)
-    df_[['upvotes', 'total_votes']] = (
-        df_['helpfulness']
-        .str.replace(',', '')
-        .str.extractall('(\d+)')
-        .unstack('match')
-        .values
+    struct = pa.array(s)
+    flat = pa.Table.from_arrays(
+        struct.flatten(), names=[field.name for field in struct.type]
     )
-    return df_.drop(columns=['helpfulness'])
-
+    # a column of empty dictionaries gives a table without columns, which
+    # has no rows either, so rows are restored by reindexing
+    return flat.to_pandas().reindex(pd.RangeIndex(len(s)))
 
-def correct_review_author(df_raw: pd.DataFrame) -> pd.DataFrame:
-    """
-    Standardizes all review author identifiers in column 'author'
-    by preserving only minimum valid part in form of '/user/urXXXXXX'.
-    """
-    if 'author' not in df_raw.columns:
-        raise ValueError('No "author" column in input data')
 
-    df_ = df_raw.copy(deep=False)
-    df_['author'] = df_['author'].astype(str).str.split('?', expand=True)[0]
-    return df_
+def normalize(df: pd.DataFrame, col: str) -> pd.DataFrame:
+    norm = flatten_struct(df[col])
+    norm.columns = norm.columns.astype(int)
+    return norm
 
 
-def cut_off_review_title_newline(df_raw: pd.DataFrame) -> pd.DataFrame:
+def transform_review_batch(batch: pa.RecordBatch) -> pa.RecordBatch:
     """
-    Removes '\n' at the end of each review title. 'title' column required.
+    Applies all review transformations to a batch of raw reviews in a single
+    pass over its columns:
+        * splits 'helpfulness' into 'upvotes' and 'total_votes',
+        * standardizes 'author' to the form of '/user/urXXXXXX',
+        * removes '\\n' at the end of 'title',
+        * converts 'date' to 'review_date' of type timestamp,
+        * downcasts numeric columns to reduce memory footprint.
+    Columns 'helpfulness', 'date' and 'Unnamed: 0' are removed.
     """
-    if 'title' not in df_raw.columns:
-        raise ValueError('No "title" column in input data')
-
-    df_ = df_raw.copy(deep=False)
-    df_['title'] = df_['title'].astype(str).str.rstrip('\n')
-    return df_
-
+    columns = dict(zip(batch.schema.names, batch.columns))
+    columns.pop('Unnamed: 0', None)
+
+    votes = pc.extract_regex(
+        pc.replace_substring(
+            pc.cast(columns.pop('helpfulness'), pa.string()), ',', ''
+        ),
+        HELPFULNESS_PATTERN
+    )
+    date = pc.utf8_trim_whitespace(pc.cast(columns.pop('date'), pa.string()))
 
-def change_review_dtypes(df_raw: pd.DataFrame) -> pd.DataFrame:
-    """
-    Changes column data types to reduce memory footprint.
-    """
-    type_mapping = {
-        'upvotes': 'int16',
-        'total_votes': 'int16',
-        'rating': 'float32'
-    }
-    return df_raw.astype(type_mapping)
+    columns['author'] = pc.replace_substring_regex(
+        pc.cast(columns['author'], pa.string()), r'\?.*', ''
+    )
+    columns['title'] = pc.utf8_rtrim(
+        pc.cast(columns['title'], pa.string()), characters='\n'
+    )
+    columns['rating'] = pc.cast(columns['rating'], pa.float32())
+    columns['upvotes'] = pc.cast(pc.struct_field(votes, [0]), pa.int32())
+    columns['total_votes'] = pc.cast(pc.struct_field(votes, [1]), pa.int32())
+    columns['review_date'] = pc.strptime(
+        date, format='%d %B %Y', unit='ns', error_is_null=True
+    )
+    return pa.RecordBatch.from_pydict(columns)
 
 
-def convert_to_date(df_raw: pd.DataFrame) -> pd.DataFrame:
+def expand_short_forms(s: pd.Series) -> pd.Series:
     """
-    Convert 'date' column of type 'object' of input data to 'review_date'
-    column of type datetime64[ns]. After transformation the 'date' column
-    is removed.
+    Replaces abbreviations of large numbers with exponents in a single
+    regex pass. Example: '2.9K' -> '2.9e+03'
     """
-    if 'date' not in df_raw.columns:
-        raise ValueError('No "date" column in input data')
-
-    df_ = df_raw.copy(deep=False)
-    df_['review_date'] = pd.to_datetime(df_['date'])
-    return df_.drop(columns=['date'])
+    return s.str.replace(
+        SHORT_FORM_PATTERN, lambda m: SHORT_FORMS[m.group(0)], regex=True
+    )
 
 
 def split_aggregate_rating(df_raw: pd.DataFrame) -> pd.DataFrame:
@@ -229,27 +284,20 @@ def split_aggregate_rating(df_raw: pd.DataFrame) -> pd.DataFrame:
     if 'agg_rating' not in df_raw.columns:
         raise ValueError('No "agg_rating" column in input data')
 
-    df_ = df_raw.copy(deep=False)
-    df_ = df_[~df_['agg_rating'].isna()]
-
-    short_forms = {
-        'K': 'e+03',
-        'M': 'e+06',
-        'B': 'e+09',
-        'T': 'e+12'
-    }
-    rating = pd.json_normalize(df_['agg_rating']).replace(
-        short_forms, regex=True
-    )
-    rating['rating'] = rating['avg_rating'].str.split('/', expand=True)[0]
-    df_[['rating', 'num_votes']] = (
-        rating
-        [['rating', 'num_votes']]
-        .astype(float)
-        .values
+    df_ = df_raw[~df_raw['agg_rating'].isna()]
+
+    rating = flatten_struct(df_['agg_rating'])
+    rating['num_votes'] = expand_short_forms(rating['num_votes'])
+    rating['rating'] = rating['avg_rating'].str.extract(
+        r'^([\d.]+)', expand=False
     )
+    values = rating[['rating', 'num_votes']].astype(float).values
 
-    return df_.drop('agg_rating', axis=1)
+    return (
+        df_
+        .assign(rating=values[:, 0], num_votes=values[:, 1])
+        .drop(columns=['agg_rating'])
+    )
 
 
 def split_review_summary(df_raw: pd.DataFrame) -> pd.DataFrame:
@@ -261,23 +309,23 @@ def split_review_summary(df_raw: pd.DataFrame) -> pd.DataFrame:
     if 'review_summary' not in df_raw.columns:
         raise ValueError('No "review_summary" column in input data')
 
-    df_ = df_raw.copy(deep=False)
-
-    short_forms = {
-        'K': 'e+03',
-        'M': 'e+06',
-        'B': 'e+09',
-        'T': 'e+12'
-    }
-
-    df_[['user_review_num', 'critic_review_num', 'metascore']] = (
-        pd.json_normalize(df_['review_summary'])
-        .replace(short_forms, regex=True)
+    values = (
+        flatten_struct(df_raw['review_summary'])
+        [['user_review_num', 'critic_review_num', 'metascore']]
+        .apply(expand_short_forms)
         .astype(float)
         .values
     )
 
-    return df_.drop('review_summary', axis=1)
+    return (
+        df_raw
+        .assign(
+            user_review_num=values[:, 0],
+            critic_review_num=values[:, 1],
+            metascore=values[:, 2]
+        )
+        .drop(columns=['review_summary'])
+    )
 
 
 def extract_tagline(df_raw: pd.DataFrame) -> pd.DataFrame:
@@ -287,9 +335,9 @@ def extract_tagline(df_raw: pd.DataFrame) -> pd.DataFrame:
     if 'tagline' not in df_raw.columns:
         raise ValueError('No "tagline" column in input data')
 
-    df_ = df_raw.copy(deep=False)
-    df_['tagline'] = df_['tagline'].str.split('Taglines', expand=True)[1]
-    return df_
+    return df_raw.assign(
+        tagline=df_raw['tagline'].str.split('Taglines', expand=True)[1]
+    )
 
 
 def extract_substrings_after_anchors(s: str, anchors: List[str])\
@@ -347,34 +395,39 @@ def extract_movie_details(df_raw: pd.DataFrame) -> pd.DataFrame:
     if 'details' not in df_raw.columns:
         raise ValueError('No "details" column in input data')
 
-    df_ = df_raw.copy(deep=False)
-
     date_pattern = 'Release date(.+?)Countr'
-    df_['release_date'] = (
-        df_['details']
+    release_date = (
+        df_raw['details']
         .str.split(date_pattern, expand=True)[1]
         .str.split(' ', expand=True)
         .agg(lambda x: f'{x[0]} {x[1]} {x[2]}', axis=1)
     )
-    df_['release_date'] = pd.to_datetime(
-        df_['release_date'], format='%B %d, %Y', errors='coerce'
-    )
 
     country_pattern = '(Country of origin|Countries of origin)(.+?)Official'
-    df_['country_of_origin'] = (
-        df_['details']
+    country_of_origin = (
+        df_raw['details']
         .str.split(country_pattern, expand=True)[2]
         .apply(lambda x: split_with_capital_letter(x))
     )
 
     company_pattern = '(Production companies|Production company)(.+?)See more'
-    df_['production_company'] = (
-        df_['details']
+    production_company = (
+        df_raw['details']
         .str.split(company_pattern, expand=True)[2]
         .apply(lambda x: split_with_capital_letter(x))
     )
 
-    return df_.drop('details', axis=1)
+    return (
+        df_raw
+        .assign(
+            release_date=pd.to_datetime(
+                release_date, format='%B %d, %Y', errors='coerce'
+            ),
+            country_of_origin=country_of_origin,
+            production_company=production_company
+        )
+        .drop(columns=['details'])
+    )
 
 
 def extract_boxoffice(df_raw: pd.DataFrame) -> pd.DataFrame:
@@ -386,23 +439,24 @@ def extract_boxoffice(df_raw: pd.DataFrame) -> pd.DataFrame:
     if 'boxoffice' not in df_raw.columns:
         raise ValueError('No "boxoffice" column in input data')
 
-    df_ = df_raw.copy(deep=False)
+    # split_pattern_regex runs on RE2, which matches in linear time
     separator = 'Budget| |Gross worldwide|See detailed'
-    df_[['budget', 'boxoffice']] = (
-        df_['boxoffice']
-        .str.split(separator, expand=True)
-        .iloc[:, [1, 12]]
-        .replace({'IMDbPro': None})
-        .values
+    parts = pc.split_pattern_regex(
+        pc.fill_null(pa.array(df_raw['boxoffice'], type=pa.string()), ''),
+        pattern=separator
     )
-    return df_
-
-
-def convert_runtime_to_minutes(hours: str, minutes: str) -> Optional[int]:
-    try:
-        return int(hours) * 60 + int(minutes)
-    except Exception:
-        return None
+    values = []
+    for position in [1, 12]:
+        # fixed size slice pads missing positions with nulls instead of
+        # raising an IndexError as pc.list_element does
+        value = pc.list_slice(
+            parts, position, position + 1, return_fixed_size_list=True
+        ).flatten()
+        value = pc.if_else(
+            pc.equal(value, 'IMDbPro'), pa.scalar(None, pa.string()), value
+        )
+        values.append(pd.arrays.ArrowStringArray(value))
+    return df_raw.assign(budget=values[0], boxoffice=values[1])
 
 
 def extract_runtime(df_raw: pd.DataFrame) -> pd.DataFrame:
@@ -414,69 +468,78 @@ def extract_runtime(df_raw: pd.DataFrame) -> pd.DataFrame:
     if 'techspecs' not in df_raw.columns:
         raise ValueError('No "techspecs" column in input data')
 
-    df_ = df_raw.copy(deep=False)
-    df_['runtime_min'] = (
-        df_['techspecs']
-        .str.split('Runtime| |Sound|Color', expand=True)
-        .replace('', '0')
-        .apply(lambda x: convert_runtime_to_minutes(x[1], x[3]), axis=1)
+    # e.g. 'Runtime2 hours 32 minutesSound mix...' -> '2 hours 32 minutes'
+    runtime = (
+        df_raw['techspecs']
+        .str.extract('Runtime(.+?)(?:Sound|Color|Aspect|$)', expand=False)
     )
-    return df_.drop('techspecs', axis=1)
+    # cast to whole minutes on the numpy level, no boxed Timedelta objects
+    minutes = (
+        pd.to_timedelta(runtime, errors='coerce')
+        .to_numpy()
+        .astype('timedelta64[m]')
+    )
+    runtime_min = pd.arrays.IntegerArray(
+        minutes.view('int64').astype('int16'), np.isnat(minutes)
+    )
+    return (
+        df_raw
+        .assign(runtime_min=runtime_min)
+        .drop(columns=['techspecs'])
+    )
+
 
+def get_order_num(match: re.Match) -> Optional[int]:
+    order_num = match.group(2)
+    return int(order_num) if order_num else None
 
-def parse_actors(x) -> Dict[str, Any]:
+
+def parse_actors(x) -> pa.RecordBatch:
     dct, title_id = x['actors'], x['title_id']
-    records = {
-        'title_id': [],
-        'actor_id': [],
-        'actor_name': [],
-        'order_num': []
-    }
-    for name, ref in dct.items():
-        records['title_id'].append(title_id)
-        records['actor_id'].append(ref.split('?')[0] + '/')
-        records['actor_name'].append(name)
-        records['order_num'].append(int(ref.split('_')[-1]))
-    return records
-
-
-def parse_recommendations(x) -> Dict[str, Any]:
+    matches = [REF_PATTERN.match(ref) for ref in dct.values()]
+    return pa.record_batch(
+        [
+            pa.array([title_id] * len(matches)),
+            pa.array([m.group(1) + '/' for m in matches]),
+            pa.array(list(dct.keys())),
+            pa.array([get_order_num(m) for m in matches])
+        ],
+        schema=ACTORS_SCHEMA
+    )
+
+
+def parse_recommendations(x) -> pa.RecordBatch:
     recomms, title_id = x['imdb_recommendations'], x['title_id']
-    records = {
-        'title_id': [],
-        'suggested_title_id': [],
-        'order_num': []
-    }
-    for recomm in recomms:
-        records['title_id'].append(title_id)
-        records['suggested_title_id'].append(recomm.split('?')[0])
-        records['order_num'].append(int(recomm.split('_')[-1]))
-    return records
-
-
-def parse_countries(x) -> Dict[str, Any]:
+    matches = [REF_PATTERN.match(recomm) for recomm in recomms]
+    return pa.record_batch(
+        [
+            pa.array([title_id] * len(matches)),
+            pa.array([m.group(1) for m in matches]),
+            pa.array([get_order_num(m) for m in matches])
+        ],
+        schema=RECOMMENDATIONS_SCHEMA
+    )
+
+
+def parse_countries(x) -> pa.RecordBatch:
     countries, title_id = x['country_of_origin'], x['title_id']
-    records = {
-        'title_id': [],
-        'country': [],
-        'order_num': []
-    }
-    for num, country in enumerate(countries):
-        records['title_id'].append(title_id)
-        records['country'].append(country)
-        records['order_num'].append(int(num + 1))
-    return records
-
-
-def parse_companies(x) -> Dict[str, Any]:
+    return pa.record_batch(
+        [
+            pa.array([title_id] * len(countries)),
+            pa.array(countries),
+            pa.array(range(1, len(countries) + 1))
+        ],
+        schema=COUNTRIES_SCHEMA
+    )
+
+
+def parse_companies(x) -> pa.RecordBatch:
     companies, title_id = x['production_company'], x['title_id']
-    records = {
-        'title_id': [],
-        'company': [],
-        'order_num': []
-    }
-    for num, company in enumerate(companies):
-        records['title_id'].append(title_id)
-        records['company'].append(company)
-        records['order_num'].append(int(num + 1))
-    return records
+    return pa.record_batch(
+        [
+            pa.array([title_id] * len(companies)),
+            pa.array(companies),
+            pa.array(range(1, len(companies) + 1))
+        ],
+        schema=COMPANIES_SCHEMA
+    )
@@ -1,13 +1,19 @@
 import os
 import re
-from time import sleep
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from typing import Dict, Any
 from pathlib import Path
+import fsspec
+from fsspec.core import url_to_fs
+import orjson
 from tqdm import tqdm
-from bs4 import BeautifulSoup
-from pandas import DataFrame
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from lxml import html, etree
 from dotenv import load_dotenv
-from recsys.utils import send_request, create_logger
+from recsys.utils import (create_logger, get_full_path, request_page,
+                          RateLimiter, REQUEST_HEADERS, BACKOFF_MAX_DELAY)
 
 
 BAR_FORMAT = '{desc:<20} {percentage:3.0f}%|{bar:20}{r_bar}'
@@ -36,11 +42,45 @@ MOVIE_COUNT_BY_GENRE = {
     'western': 8880
 }
 GENRES = list(MOVIE_COUNT_BY_GENRE.keys())
-URL_TEMPLATE = (
-    'https://www.imdb.com/search/title/?title_type=feature&genres={}'
-    '&sort=num_votes,desc&start={}&explore=genres&ref_=adv_nxt'
+GENRES_SET = frozenset(GENRES)
+# the largest genres go first, so the longest scraping starts earlier and
+# the order of genres is the same on every run
+GENRES_BY_COUNT = tuple(
+    sorted(GENRES, key=MOVIE_COUNT_BY_GENRE.get, reverse=True)
+)
+# number of movies in one percent of a genre, used for pct_titles sampling
+MOVIE_COUNT_PER_PCT = {
+    genre: count / 100 for genre, count in MOVIE_COUNT_BY_GENRE.items()
+}
+# genre and rank parameters go last, so a page URL is built by appending
+# them to a constant prefix
+URL_PREFIX = (
+    'https://www.imdb.com/search/title/?title_type=feature'
+    '&sort=num_votes,desc&explore=genres&ref_=adv_nxt&genres='
 )
 STEP = 50
+REQUEST_TIMEOUT = 30
+# XPath expressions are compiled once and reused for every search page
+TITLE_XPATH = etree.XPath("//div[@class='lister-item-content']")
+# plain strings are returned instead of lxml string subclasses, which can
+# not be serialized with orjson
+TITLE_ID_XPATH = etree.XPath('string(h3/a/@href)', smart_strings=False)
+GENRE_XPATH = etree.XPath(
+    "string(.//span[@class='genre'])", smart_strings=False
+)
+# search results are placed between these tags, the rest of a page (header,
+# scripts, footer) is not needed for collecting identifiers
+TITLE_LIST_START = b'<div class="lister-list">'
+TITLE_LIST_END = b'<div class="desc">'
+# from each title only its header with identifier and genres are needed
+TITLE_FRAGMENT_PATTERN = re.compile(
+    rb'<h3 class="lister-item-header">.*?</h3>|<span class="genre">.*?</span>',
+    re.DOTALL
+)
+TITLE_START = b'<div class="lister-item-content">'
+TITLE_END = b'</div>'
+# page slices have no <meta charset>, so the encoding is set explicitly
+HTML_PARSER = html.HTMLParser(encoding='utf-8')
 
 
 class IDCollector:
@@ -88,6 +128,18 @@ class IDCollector:
         server for a long period of time is not ethical and such requests could
         be rate limited as a result).
 
+        * concurrency: maximum number of pages requested at the same time.
+        Requests of all workers share one rate limit: a new request is sent
+        no sooner than sleep_time seconds after the previous one.
+
+        * verbose: if set to true, progress bar is shown for each genre.
+        Set to false for headless runs, where logs are enough.
+
+        * checkpoint_dir: local folder to save identifiers collected from
+        each page to. If collecting is interrupted, already parsed pages are
+        not requested again on the next run. Checkpoints are removed after
+        all identifiers are saved.
+
         * log_file: file name to write logs related to collecting IDs.
 
         * log_level: minimal level of log messages.
@@ -103,6 +155,9 @@ class IDCollector:
         self._mode = config['mode']
         self._genres = config['genres']
         self._sleep_time = config['sleep_time']
+        self._concurrency = config['concurrency']
+        self._verbose = config['verbose']
+        self._checkpoint_dir = get_full_path(config['checkpoint_dir'])
         n_titles = config['n_titles']
         pct_titles = config['pct_titles']
 
@@ -151,17 +206,20 @@ class IDCollector:
             self._genres = [self._genres]
 
         if 'all' not in self._genres:
-            use_genres = set(self._genres).intersection(GENRES)
-            genre_diff = set(self._genres) - set(use_genres)
+            genres = set(self._genres)
+            use_genres = genres & GENRES_SET
+            genre_diff = genres - use_genres
             if genre_diff:
                 self._logger.warning(
-                    f'No {", ".join(genre_diff)} in possible genres'
+                    'No %s in possible genres', ', '.join(genre_diff)
                 )
             if not use_genres:
                 raise ValueError('No valid genres were passed')
-            self._genres = use_genres
+            self._genres = tuple(
+                genre for genre in GENRES_BY_COUNT if genre in use_genres
+            )
         else:
-            self._genres = GENRES
+            self._genres = GENRES_BY_COUNT
 
         if not (n_titles or pct_titles):
             raise ValueError(
@@ -174,7 +232,7 @@ class IDCollector:
                     'pct_titles must lie in the interval [0, 100]'
                 )
             self._sample_size = {
-                genre: int(pct_titles / 100 * MOVIE_COUNT_BY_GENRE[genre])
+                genre: int(pct_titles * MOVIE_COUNT_PER_PCT[genre])
                 for genre in self._genres
             }
         else:
@@ -183,85 +241,268 @@ class IDCollector:
                 for genre in self._genres
             }
 
+        self._ranks = {
+            genre: range(1, self._sample_size[genre] + 1, STEP)
+            for genre in self._genres
+        }
+        self._genre_url = {
+            genre: f'{URL_PREFIX}{genre}&start=' for genre in self._genres
+        }
+
         self._logger.info('Successfully initialized IDCollector')
 
     @staticmethod
-    def collect_movie_id(soup: BeautifulSoup) -> Dict[str, Dict[str, str]]:
-        title_raw = soup.find_all('div', {'class': 'lister-item-content'})
-        title_id = [t.a['href'] for t in title_raw]
-        main_genre = [
-            extract_main_genre(t.find('span', {'class': 'genre'}).text)
-            for t in title_raw
-        ]
-        return {t: {'main_genre': g} for t, g in zip(title_id, main_genre)}
-
-    def _collect_rank_id(self, genre, rank) -> Dict[str, Dict[str, str]]:
-        url = URL_TEMPLATE.format(genre, rank)
-        rank_id = {}
-        try:
-            response = send_request(url)
-            soup = BeautifulSoup(response.content, 'html.parser')
-            if response.status_code == 200:
-                old_len = len(rank_id)
-                rank_id |= IDCollector.collect_movie_id(soup)
+    def collect_movie_id(page: bytes) -> Dict[str, Dict[str, str]]:
+        titles = strain_title_list(page)
+        if not titles:
+            return {}
+        tree = html.fromstring(titles, parser=HTML_PARSER)
+        return {
+            TITLE_ID_XPATH(t): {
+                'main_genre': extract_main_genre(GENRE_XPATH(t))
+            }
+            for t in TITLE_XPATH(tree)
+        }
+
+    async def _collect_rank_id(self, genre: str, rank: int)\
+            -> Dict[str, Dict[str, str]]:
+        url = self._genre_url[genre] + str(rank)
+        async with self._semaphore:
+            try:
+                status, content = await request_page(
+                    self._session, url, self._limiter, self._logger
+                )
+                if status != 200:
+                    self._logger.warning(
+                        'Bad status code in genre %s, rank %d-%d',
+                        genre.upper(), rank, rank + STEP
+                    )
+                    return {}
+                if not content:
+                    self._logger.warning(
+                        'Empty page in genre %s, rank %d-%d',
+                        genre.upper(), rank, rank + STEP
+                    )
+                    return {}
+
+                # parsing is CPU bound, so it runs in a separate process
+                # while the event loop keeps serving other requests
+                rank_id = await asyncio.get_running_loop().run_in_executor(
+                    self._parse_pool, IDCollector.collect_movie_id, content
+                )
+                self._save_checkpoint(genre, rank, rank_id)
+                # messages are formatted by logger only if they are emitted
                 self._logger.info(
-                    f'Collected {len(rank_id) - old_len} new identifiers'
-                    f' while parsing genre {genre.upper()},'
-                    f' rank {rank}-{rank + STEP}'
+                    'Collected %d new identifiers while parsing genre %s,'
+                    ' rank %d-%d', len(rank_id), genre.upper(), rank,
+                    rank + STEP
                 )
-            else:
+                return rank_id
+            except Exception as e:
+                # only errors of a single page are skipped, interruption
+                # and cancellation stop the whole collecting
                 self._logger.warning(
-                    f'Bad status code in genre {genre.upper()},'
-                    f' rank {rank}-{rank + STEP}'
+                    'Exception in genre %s, rank %d-%d with message: %s',
+                    genre.upper(), rank, rank + STEP, e
                 )
-        except Exception as e:
-            self._logger.warning(
-                f'Exception in genre {genre.upper()},'
-                f' rank {rank}-{rank + STEP}'
-                f' with message: {e}'
+                return {}
+
+    def _get_checkpoint_path(self, genre: str) -> str:
+        return os.path.join(self._checkpoint_dir, f'{genre}.ckpt.jsonl')
+
+    def _save_checkpoint(self, genre: str, rank: int,
+                         rank_id: Dict[str, Dict[str, str]]) -> None:
+        with open(self._get_checkpoint_path(genre), 'ab') as checkpoint:
+            record = {'rank': rank, 'ids': rank_id}
+            checkpoint.write(orjson.dumps(record) + b'\n')
+
+    def _load_checkpoint(self, genre: str) -> Dict[int, Dict[str, Any]]:
+        path = self._get_checkpoint_path(genre)
+        if not os.path.exists(path):
+            return {}
+
+        rank_ids = {}
+        with open(path, 'rb') as checkpoint:
+            for line in checkpoint:
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # the last line could be written partially
+                    continue
+                rank_ids[record['rank']] = record['ids']
+        return rank_ids
+
+    def _write_ids(self, ids: Dict[str, Dict[str, str]]) -> int:
+        """
+        Appends identifiers which were not written before to the output
+        file. Returns number of written identifiers.
+        """
+        separator = b',' if self._written_ids else b''
+        entries = []
+        for title_id, title_data in ids.items():
+            # the same title is usually found in several genres, it is saved
+            # only once, with the data from the first page it was found on
+            if title_id in self._written_ids:
+                continue
+            self._written_ids.add(title_id)
+            entries.append(
+                orjson.dumps(title_id) + encode_title_data(title_data)
+            )
+        if entries:
+            self._output.write(separator + b','.join(entries))
+        return len(entries)
+
+    async def _collect_ids_for_genre(self, genre: str) -> int:
+        new_ids = 0
+        collected_ranks = self._load_checkpoint(genre)
+        if collected_ranks:
+            # pages of a genre hold different titles, so restored pages are
+            # merged and written at once rather than page by page
+            restored_ids = {}
+            for rank_id in collected_ranks.values():
+                restored_ids.update(rank_id)
+            new_ids += self._write_ids(restored_ids)
+            self._logger.info(
+                'Restored %d pages of genre %s from checkpoint',
+                len(collected_ranks), genre.upper()
             )
-        finally:
-            return rank_id
 
-    def _collect_ids_for_genre(self, genre: str) -> Dict[str, Dict[str, str]]:
-        genre_id = {}
+        ranks = [
+            rank for rank in self._ranks[genre]
+            if rank not in collected_ranks
+        ]
         tqdm_params = {
-            'iterable': range(1, self._sample_size[genre] + 1, STEP),
+            'iterable': asyncio.as_completed([
+                self._collect_rank_id(genre, rank) for rank in ranks
+            ]),
+            'total': len(ranks),
             'desc': genre,
             'unit_scale': STEP,
-            'bar_format': BAR_FORMAT
+            'bar_format': BAR_FORMAT,
+            # pages of all genres are completed concurrently, so the bars
+            # are redrawn at most twice a second rather than on every page
+            'mininterval': 0.5,
+            'miniters': 10,
+            # None turns the bar off when output is not a terminal
+            'disable': None if self._verbose else True
         }
-        for rank in tqdm(**tqdm_params):
-            genre_id |= self._collect_rank_id(genre, rank)
-
-            sleep(self._sleep_time)
+        for rank_id in tqdm(**tqdm_params):
+            new_ids += self._write_ids(await rank_id)
 
-        return genre_id
+        self._logger.info(
+            'Collected %d new identifiers of genre %s', new_ids, genre.upper()
+        )
+        return new_ids
+
+    async def _collect_ids(self) -> int:
+        os.makedirs(self._checkpoint_dir, exist_ok=True)
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        # requests of all workers are spaced by sleep_time seconds, so the
+        # total request rate does not grow with concurrency
+        self._limiter = RateLimiter(max_rate=1, time_period=self._sleep_time)
+        # One connection per worker is opened and then reused for all pages.
+        # Idle connections are kept alive longer than the longest backoff
+        # pause, so TLS handshakes are not repeated after rate limiting.
+        # All pages are on one host, so its address is resolved only once.
+        connector = TCPConnector(
+            limit_per_host=self._concurrency,
+            keepalive_timeout=BACKOFF_MAX_DELAY + self._sleep_time,
+            ttl_dns_cache=None
+        )
+        session_params = {
+            'connector': connector,
+            'headers': REQUEST_HEADERS,
+            'timeout': ClientTimeout(total=REQUEST_TIMEOUT)
+        }
+        # no more than `concurrency` pages are in flight at once, so there
+        # is no need in more parsing processes than that
+        parse_pool = ProcessPoolExecutor(max_workers=self._concurrency)
+        with parse_pool as self._parse_pool:
+            async with ClientSession(**session_params) as self._session:
+                genre_ids = await asyncio.gather(*[
+                    self._collect_ids_for_genre(genre)
+                    for genre in self._genres
+                ])
+        return sum(genre_ids)
 
     def collect(self) -> None:
         """
         Parses relevant web pages to extract movie identifiers and write
-        them on a disk or cloud.
+        them on a disk or cloud. Pages are requested concurrently, at most
+        "concurrency" requests at a time. Identifiers are written to the
+        output file as soon as a page is parsed, so they are not
+        accumulated in memory.
         """
         print('Collecting identifiers...')
 
-        id_genre = {}
+        # only identifiers are kept to skip duplicates, their data goes
+        # straight to the output file
+        self._written_ids = set()
+        storage_options = self._storage_options or {}
+        # identifiers are written to a temporary file, which replaces the
+        # output file only when it is complete, so a failed run does not
+        # leave truncated JSON in place of the previous file
+        tmp_file = f'{self._metadata_file}.tmp'
+        with fsspec.open(tmp_file, 'wb', **storage_options) as self._output:
+            self._output.write(b'{')
+            total_ids = asyncio.run(self._collect_ids())
+            self._output.write(b'}')
+        fs, _ = url_to_fs(tmp_file, **storage_options)
+        fs.mv(tmp_file, self._metadata_file)
+
+        self._logger.info('Saved %d identifiers', total_ids)
 
         for genre in self._genres:
-            old_len = len(id_genre)
-            id_genre |= self._collect_ids_for_genre(genre)
+            path = self._get_checkpoint_path(genre)
+            if os.path.exists(path):
+                os.remove(path)
 
-            self._logger.info(
-                f'Collected {len(id_genre) - old_len} new identifiers'
-            )
 
-            sleep(self._sleep_time)
+@lru_cache(maxsize=None)
+def encode_main_genre(main_genre: str) -> bytes:
+    return b':' + orjson.dumps({'main_genre': main_genre})
 
-        DataFrame.from_dict(id_genre, orient='index').to_json(
-            self._metadata_file,
-            storage_options=self._storage_options
-        )
+
+def encode_title_data(title_data: Dict[str, str]) -> bytes:
+    """
+    Encodes data of a title as a value of JSON object entry. Data of all
+    titles consists of the main genre only, which takes one of a few values,
+    so encoded values are cached by genre.
+    """
+    return encode_main_genre(title_data['main_genre'])
+
+
+def slice_title_list(page: bytes) -> bytes:
+    """
+    Cuts off the part of a search page containing the list of titles.
+    The whole page is returned if there is no such list.
+    """
+    start = page.find(TITLE_LIST_START)
+    if start == -1:
+        return page
+    end = page.find(TITLE_LIST_END, start)
+    return page[start:end] if end != -1 else page[start:]
+
+
+def strain_title_list(page: bytes) -> bytes:
+    """
+    Leaves only header and genres of each title on a search page, the rest
+    of title blocks (posters, ratings, descriptions, cast) is not parsed.
+    """
+    titles = []
+    for match in TITLE_FRAGMENT_PATTERN.finditer(slice_title_list(page)):
+        fragment = match.group()
+        # header goes first in a title block, so it starts a new title
+        if fragment.startswith(b'<h3'):
+            titles.append([fragment])
+        elif titles:
+            titles[-1].append(fragment)
+    return b''.join(
+        TITLE_START + b''.join(title) + TITLE_END for title in titles
+    )
 
 
 def extract_main_genre(s: str) -> str:
-    return re.split(', | ', s.replace('\n', ''))[0]
+    # only the first genre is needed, it ends with ', ' or ' ' if there
+    # are other genres, e.g. 'Action, Adventure, Comedy' -> 'Action'
+    return s.replace('\n', '').partition(' ')[0].removesuffix(',')
@@ -1,19 +1,81 @@
 import os
-import re
-from time import sleep
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Optional, Dict, List, Any, Union
-from pandas import DataFrame, read_json
-from bs4 import BeautifulSoup
+from typing import Optional, Dict, List, Tuple, Any, Union, Iterator
+import orjson
+from fsspec.core import url_to_fs
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from lxml import html, etree
 from tqdm import tqdm
 from dotenv import load_dotenv
-from recsys.utils import send_request, create_logger
+from recsys.utils import (create_logger, request_page, RateLimiter,
+                          REQUEST_HEADERS, REQUEST_TIMEOUT,
+                          BACKOFF_MAX_DELAY)
 
 
 BAR_FORMAT = '{percentage:3.0f}%|{bar:20}{r_bar}'
-BASE_URL = 'https://www.imdb.com{}'
+# title ids are paths like '/title/tt7991608/', so a page URL is built by
+# appending them to the site address
+BASE_URL = 'https://www.imdb.com'
 TOP_N_ACTORS = 10
 BATCH_SIZE = 50
+# IMDB pages are served in UTF-8, so lxml does not need to detect encoding
+# of a page
+HTML_PARSER = html.HTMLParser(encoding='utf-8')
+# Title details are rendered inside page body. Page head (styles, preload
+# links) and serialized page data appended after the rendered markup are
+# several times larger than the details and are not parsed.
+PAGE_BODY_START = b'<body'
+PAGE_DATA_START = b'<script id="__NEXT_DATA__"'
+# Nodes needed to collect title details are selected in three walks over
+# a page: elements with data-testid attribute, review scores and
+# recommendation cards. Details are then taken from these nodes only.
+TEST_ID_NODES_XPATH = etree.XPath('//*[@data-testid]')
+REVIEW_SCORE_XPATH = etree.XPath(
+    "//span[contains(concat(' ', normalize-space(@class), ' '), ' score ')]"
+)
+RECOMMENDATION_XPATH = etree.XPath(
+    "//a[contains(@class, 'ipc-poster-card__title')]"
+)
+IMG_SRC_XPATH = etree.XPath('.//img/@src', smart_strings=False)
+NESTED_A_XPATH = etree.XPath('.//a')
+NESTED_LI_XPATH = etree.XPath('.//li')
+NESTED_DIV_XPATH = etree.XPath('.//div')
+# nodes of a page are indexed by their tag and data-testid, nodes without
+# data-testid get these keys
+REVIEW_SCORE_KEY = ('span', '.score')
+RECOMMENDATION_KEY = ('a', '.ipc-poster-card__title')
+ORIGINAL_TITLE_KEY = ('h1', 'hero-title-block__title')
+POSTER_KEY = ('div', 'hero-media__poster')
+AGGREGATE_RATING_KEY = ('div', 'hero-rating-bar__aggregate-rating')
+ACTOR_KEY = ('a', 'title-cast-item__actor')
+GENRES_KEY = ('div', 'genres')
+RUNTIME_KEY = ('li', 'title-techspec_runtime')
+# rating is followed by its scale and then by number of votes
+RATING_SCALE = '/10'
+# pairs of detail name and index key of its list item
+DETAILS_KEYS = (
+    ('release_date', ('li', 'title-details-releasedate')),
+    ('countries_of_origin', ('li', 'title-details-origin')),
+    ('language', ('li', 'title-details-languages')),
+    ('also_known_as', ('li', 'title-details-akas')),
+    ('production_companies', ('li', 'title-details-companies')),
+    ('filming_locations', ('li', 'title-details-filminglocations'))
+)
+BOXOFFICE_KEYS = (
+    ('budget', ('li', 'title-boxoffice-budget')),
+    ('boxoffice_gross_domestic', ('li', 'title-boxoffice-grossdomestic')),
+    ('boxoffice_gross_opening',
+     ('li', 'title-boxoffice-openingweekenddomestic')),
+    ('boxoffice_gross_worldwide',
+     ('li', 'title-boxoffice-cumulativeworldwidegross'))
+)
+
+
+# nodes of a title page grouped by tag and data-testid attribute
+PageIndex = Dict[Tuple[str, str], List[html.HtmlElement]]
 
 
 class MetadataCollector:
@@ -52,6 +114,10 @@ class MetadataCollector:
         server for a long period of time is not ethical and such requests could
         be rate limited as a result).
 
+        * concurrency: maximum number of pages requested at the same time.
+        Requests of all workers share one rate limit: a new request is sent
+        no sooner than sleep_time seconds after the previous one.
+
         * log_file: file name to write logs related to collecting IDs.
 
         * log_level: minimal level of log messages.
@@ -63,6 +129,7 @@ class MetadataCollector:
         self._mode = config['mode']
         self._chunk_size = config['chunk_size']
         self._sleep_time = config['sleep_time']
+        self._concurrency = config['concurrency']
 
         if self._mode == 'cloud':
             load_dotenv()
@@ -105,10 +172,17 @@ class MetadataCollector:
             level=config['log_level']
         )
 
+        # batches of collected titles are saved next to metadata file until
+        # the whole file is updated at the end of collecting
+        self._fs, _ = url_to_fs(
+            self._metadata_file, **(self._storage_options or {})
+        )
+        self._parts_dir = f'{self._metadata_file}.parts'
+
         self._logger.info('Successfully initialized MetadataCollector')
 
     @staticmethod
-    def collect_title_details(soup: BeautifulSoup) -> Dict[str, Any]:
+    def collect_title_details(tree: html.HtmlElement) -> Dict[str, Any]:
         """
         Collects the following details (if exists) about a single movie:
             * original title
@@ -120,16 +194,17 @@ class MetadataCollector:
             * boxoffice
             * runtime
         """
+        index = index_page(tree)
         return {
-            'original_title': collect_original_title(soup),
-            'genres': collect_genres(soup),
-            'poster_url': collect_poster_url(soup),
-            'review_summary': collect_review_summary(soup),
-            'agg_rating': collect_aggregate_rating(soup),
-            'actors': collect_actors(soup),
-            'imdb_recommendations': collect_imdb_recommendations(soup),
-            'details': collect_details_summary(soup),
-            'boxoffice': collect_boxoffice(soup)
+            'original_title': collect_original_title(index),
+            'genres': collect_genres(index),
+            'poster_url': collect_poster_url(index),
+            'review_summary': collect_review_summary(index),
+            'agg_rating': collect_aggregate_rating(index),
+            'actors': collect_actors(index),
+            'imdb_recommendations': collect_imdb_recommendations(index),
+            'details': collect_details_summary(index),
+            'boxoffice': collect_boxoffice(index)
         }
 
     def is_all_metadata_collected(self) -> bool:
@@ -137,16 +212,12 @@ class MetadataCollector:
         Checks are there any movie in a database which metadata was not
         collected yet.
         """
-        metadata_df = read_json(
-            self._metadata_file,
-            storage_options=self._storage_options,
-            orient='index'
+        movie_metadata = self._load_metadata()
+        already_collected = sum(
+            1 for data in movie_metadata.values()
+            if data.get('genres') is not None
         )
-        if 'genres' not in metadata_df.columns:
-            already_collected = 0
-        else:
-            already_collected = (~metadata_df['genres'].isna()).sum()
-        total_movies = len(metadata_df['genres'])
+        total_movies = len(movie_metadata)
 
         print(
             f'Movie metadata is already collected for {already_collected}'
@@ -154,204 +225,298 @@ class MetadataCollector:
         )
         return total_movies == already_collected
 
-    def collect(self) -> None:
+    def _load_metadata(self) -> Dict[str, Dict[str, Any]]:
+        with self._fs.open(self._metadata_file, 'rb') as metadata_file:
+            return orjson.loads(metadata_file.read())
+
+    async def _collect_title(self, title_id: str) -> Optional[Dict[str, Any]]:
+        url = BASE_URL + title_id
+        try:
+            status, content = await request_page(
+                self._session, url, self._limiter, self._logger
+            )
+            if status != 200 or not content:
+                self._logger.warning('Bad status code %d for %s', status, url)
+                return None
+
+            # parsing is CPU bound, so it runs in a separate process
+            # while the event loop keeps serving other requests
+            details = await asyncio.get_running_loop().run_in_executor(
+                self._parse_pool, parse_title_page, content
+            )
+            self._logger.info('Collected metadata for title %s', title_id)
+            return details
+        except Exception as e:
+            self._logger.warning('Exception %s in parsing %s', e, url)
+            return None
+
+    def _save_batch(self) -> None:
         """
-        Parses relevant web pages to extract movie identifiers and write
-        them on a disk or cloud.
+        Writes details of titles collected since the previous batch to a new
+        part file. Only the batch is written, not the whole metadata.
         """
-        print('Collecting metadata...')
+        self._fs.makedirs(self._parts_dir, exist_ok=True)
+        part_path = f'{self._parts_dir}/part-{self._part_num:05d}.jsonl'
+        with self._fs.open(part_path, 'wb') as part:
+            part.write(b''.join(
+                orjson.dumps({title_id: details}) + b'\n'
+                for title_id, details in self._batch.items()
+            ))
+        self._logger.info('Saved batch with %d titles', len(self._batch))
+        self._part_num += 1
+        self._batch = {}
+
+    def _load_batches(self) -> None:
+        """
+        Merges batches saved by an interrupted run into metadata.
+        """
+        part_paths = sorted(self._fs.glob(f'{self._parts_dir}/part-*.jsonl'))
+        for part_path in part_paths:
+            with self._fs.open(part_path, 'rb') as part:
+                for line in part:
+                    for title_id, details in orjson.loads(line).items():
+                        self._movie_metadata[title_id] |= details
+        self._part_num = len(part_paths)
+        if part_paths:
+            self._logger.info(
+                'Restored %d batches from previous run', len(part_paths)
+            )
 
-        movie_metadata_df = read_json(
-            self._metadata_file,
-            storage_options=self._storage_options,
-            orient='index'
+    def _save_metadata(self) -> None:
+        # metadata is written to a temporary file which then replaces the
+        # metadata file, so an interrupted write does not leave it truncated
+        tmp_file = f'{self._metadata_file}.tmp'
+        with self._fs.open(tmp_file, 'wb') as metadata_file:
+            metadata_file.write(orjson.dumps(self._movie_metadata))
+        self._fs.mv(tmp_file, self._metadata_file)
+        self._logger.info(
+            'Updated metadata file with %d titles', self._session_counter
         )
-        movie_metadata = movie_metadata_df.T.to_dict()
-
-        title_ids = [t for t, _ in movie_metadata.items()]
-        counter = 0
-        session_counter = 0
-        for i, title_id in tqdm(
-            enumerate(title_ids), total=len(title_ids), bar_format=BAR_FORMAT
-        ):
-            if movie_metadata[title_id].get('original_title', None):
+        # all batches are in the metadata file now
+        if self._fs.exists(self._parts_dir):
+            self._fs.rm(self._parts_dir, recursive=True)
+
+    async def _collect_titles(self, title_ids: Iterator[str],
+                              progress_bar: tqdm) -> None:
+        # every worker takes next title from the shared iterator, so each
+        # title is requested only once
+        for title_id in title_ids:
+            if self._session_counter >= self._chunk_size:
+                return
+
+            details = await self._collect_title(title_id)
+            progress_bar.update()
+            if details is None:
                 continue
 
-            url = BASE_URL.format(title_id)
-            try:
-                title_page = send_request(url)
-                soup = BeautifulSoup(title_page.text, 'lxml')
+            self._movie_metadata[title_id] |= details
+            self._batch[title_id] = details
+            self._session_counter += 1
+            # save results after if we have enough new data
+            if len(self._batch) == BATCH_SIZE:
+                self._save_batch()
+
+    async def _collect_async(self) -> None:
+        self._movie_metadata = self._load_metadata()
+        self._batch = {}
+        self._load_batches()
+
+        # titles collected on previous runs are filtered out once, so
+        # progress bar shows only the remaining work
+        title_ids = [
+            title_id for title_id, data in self._movie_metadata.items()
+            if not data.get('original_title', None)
+        ]
+        self._logger.info(
+            '%d out of %d titles are left to collect',
+            len(title_ids), len(self._movie_metadata)
+        )
+        self._session_counter = 0
+        # requests of all workers are spaced by sleep_time seconds
+        self._limiter = RateLimiter(max_rate=1, time_period=self._sleep_time)
+        # Idle connections are kept alive longer than the longest backoff
+        # pause, so TLS handshakes are not repeated after rate limiting.
+        connector = TCPConnector(
+            limit_per_host=self._concurrency,
+            keepalive_timeout=BACKOFF_MAX_DELAY + self._sleep_time,
+            ttl_dns_cache=None
+        )
+        session_params = {
+            'connector': connector,
+            'headers': REQUEST_HEADERS,
+            'timeout': ClientTimeout(total=REQUEST_TIMEOUT)
+        }
+        title_ids_iter = iter(title_ids)
+        progress_bar = tqdm(
+            total=len(title_ids),
+            bar_format=BAR_FORMAT,
+            # the bar is redrawn at most once a second rather than on every
+            # title, and is not drawn at all when output is not a terminal
+            mininterval=1.0,
+            miniters=10,
+            smoothing=0,
+            disable=None
+        )
+        # each worker has at most one page to parse at a time, so there is
+        # no need in more parsing processes than workers
+        parse_pool = ProcessPoolExecutor(
+            max_workers=min(self._concurrency, os.cpu_count())
+        )
+        with progress_bar, parse_pool as self._parse_pool:
+            async with ClientSession(**session_params) as self._session:
+                await asyncio.gather(*[
+                    self._collect_titles(title_ids_iter, progress_bar)
+                    for _ in range(self._concurrency)
+                ])
+
+        if self._batch:
+            self._save_batch()
+        self._save_metadata()
+        # stop program if we scraped many pages. This could be useful
+        # if we have a limit on total running time (e.g. using
+        # AWS Lambda)
+        if self._session_counter >= self._chunk_size:
+            self._logger.info('Stop parsing due to requests limit')
 
-                details = self.collect_title_details(soup)
-                movie_metadata[title_id] |= details
+    def collect(self) -> None:
+        """
+        Parses relevant web pages to extract movie identifiers and write
+        them on a disk or cloud. Pages are requested concurrently, at most
+        "concurrency" requests at a time.
+        """
+        print('Collecting metadata...')
 
-                counter += 1
+        asyncio.run(self._collect_async())
 
-                self._logger.info(f'Collected metadata for title {title_id}')
-                title_page.close()
-            except Exception as e:
-                self._logger.warn(f'Exception {str(e)} in parsing {url}')
-            finally:
-                sleep(self._sleep_time)
 
-            # save results after if we have enough new data
-            if (counter == BATCH_SIZE) | (i == len(title_ids) - 1):
-                session_counter += counter
-                counter = 0
-
-                # update metadata file
-                DataFrame(movie_metadata).to_json(
-                    self._metadata_file,
-                    storage_options=self._storage_options
-                )
+def parse_title_page(page: bytes) -> Dict[str, Any]:
+    tree = html.fromstring(slice_title_page(page), parser=HTML_PARSER)
+    return MetadataCollector.collect_title_details(tree)
 
-                self._logger.info(
-                    f'Updated metadata file with {BATCH_SIZE} titles'
-                )
 
-                # stop program if we scraped many pages. This could be useful
-                # if we have a limit on total running time (e.g. using
-                # AWS Lambda)
-                if session_counter >= self._chunk_size:
-                    self._logger.info('Stop parsing due to requests limit')
-                    return
+def slice_title_page(page: bytes) -> bytes:
+    """
+    Cuts off the rendered body of a title page. Parts of the page which
+    are not found are kept, so the whole page is returned in the worst case.
+    """
+    start = max(page.find(PAGE_BODY_START), 0)
+    end = page.find(PAGE_DATA_START, start)
+    return page[start:end] if end != -1 else page[start:]
 
 
-def collect_original_title(soup: BeautifulSoup) -> Optional[str]:
-    filters = {'data-testid': 'hero-title-block__title'}
-    try:
-        return soup.find('h1', filters).text
-    except Exception:
+def index_page(tree: html.HtmlElement) -> PageIndex:
+    """
+    Selects all nodes containing title details and groups them by tag and
+    data-testid attribute. Nodes keep the document order.
+    """
+    index = defaultdict(list)
+    for node in TEST_ID_NODES_XPATH(tree):
+        index[(node.tag, node.get('data-testid'))].append(node)
+    index[REVIEW_SCORE_KEY] = REVIEW_SCORE_XPATH(tree)
+    index[RECOMMENDATION_KEY] = RECOMMENDATION_XPATH(tree)
+    return index
+
+
+def collect_original_title(index: PageIndex) -> Optional[str]:
+    nodes = index.get(ORIGINAL_TITLE_KEY)
+    if not nodes:
         return None
+    return nodes[0].text_content()
 
 
-def collect_poster_url(soup: BeautifulSoup) -> Optional[str]:
-    filters = {'data-testid': 'hero-media__poster'}
-    try:
-        return soup.find('div', filters).img['src']
-    except Exception:
+def collect_poster_url(index: PageIndex) -> Optional[str]:
+    nodes = index.get(POSTER_KEY)
+    if not nodes:
         return None
+    img_srcs = IMG_SRC_XPATH(nodes[0])
+    return img_srcs[0] if img_srcs else None
 
 
-def collect_review_summary(soup: BeautifulSoup)\
-        -> Optional[Dict[str, Any]]:
+def collect_review_summary(index: PageIndex) -> Optional[Dict[str, Any]]:
     keys = ['user_review_num', 'critic_review_num', 'metascore']
-    try:
-        scores = [sc.text for sc in soup.find_all('span', class_=['score'])]
-    except Exception:
-        scores = [None, None, None]
+    scores = [sc.text_content() for sc in index.get(REVIEW_SCORE_KEY, [])]
     return dict(zip(keys, scores))
 
 
-def collect_aggregate_rating(soup: BeautifulSoup) -> Optional[Dict[str, str]]:
-    filters = {'data-testid': 'hero-rating-bar__aggregate-rating'}
-    try:
-        rating_raw = soup.find('div', filters).text
-        rating, votes = (
-            rating_raw
-            .replace('IMDb RATING', '')
-            .replace('/10', '/10?')
-            .split('?')
-        )
-        return {'avg_rating': rating, 'num_votes': votes}
-    except Exception:
+def collect_aggregate_rating(index: PageIndex) -> Optional[Dict[str, str]]:
+    nodes = index.get(AGGREGATE_RATING_KEY)
+    if not nodes:
         return None
+    # e.g. 'IMDb RATING6.3/10258K' -> ('6.3/10', '258K')
+    rating, scale, votes = (
+        nodes[0]
+        .text_content()
+        .replace('IMDb RATING', '')
+        .partition(RATING_SCALE)
+    )
+    if not scale or RATING_SCALE in votes:
+        return None
+    return {'avg_rating': rating + scale, 'num_votes': votes}
+
 
+def get_id_and_rank(s: str) -> Tuple[Optional[str], Optional[str]]:
+    # e.g. '/name/nm0425005/?ref_=tt_cl_t_1' -> ('/name/nm0425005/', '1')
+    if not s:
+        return None, None
+    return s.partition('?')[0], s.partition('_t_')[2] or None
 
-def get_id_and_rank(s: str) -> Dict[str, Any]:
-    id_ = s.split('?')[0] if s else None
-    rank = s.split('_t_')[1] if s else None
-    return id_, rank
 
+def get_hrefs(nodes: List[html.HtmlElement]) -> List[str]:
+    return [
+        href for href in (node.get('href') for node in nodes)
+        if href is not None
+    ]
 
-def collect_actors(soup: BeautifulSoup) -> Dict[str, str]:
-    filters = {'data-testid': 'title-cast-item__actor'}
-    try:
-        actors_raw = soup.find_all('a', filters)
-        actors = {}
-        for actor in actors_raw[:TOP_N_ACTORS]:
-            id_, rank = get_id_and_rank(actor.get('href', None))
+
+def collect_actors(index: PageIndex) -> Dict[str, str]:
+    actors = {}
+    for href in get_hrefs(index.get(ACTOR_KEY, []))[:TOP_N_ACTORS]:
+        id_, rank = get_id_and_rank(href)
+        # links without rank can not be keyed, they are skipped
+        if rank is not None:
             actors[rank] = id_
-        return actors
-    except Exception:
-        return {}
-
-
-def collect_imdb_recommendations(soup: BeautifulSoup)\
-        -> Optional[List[str]]:
-    filters = {'class': re.compile('ipc-poster-card__title')}
-    try:
-        recom_raw = soup.find_all('a', filters)
-        recommendations = {}
-        for recom in recom_raw:
-            id_, rank = get_id_and_rank(recom.get('href', None))
+    return actors
+
+
+def collect_imdb_recommendations(index: PageIndex) -> Optional[List[str]]:
+    recommendations = {}
+    for href in get_hrefs(index.get(RECOMMENDATION_KEY, [])):
+        id_, rank = get_id_and_rank(href)
+        if rank is not None:
             recommendations[rank] = id_
-        return recommendations
-    except Exception:
-        return {}
+    return recommendations
 
 
-def collect_genres(soup: BeautifulSoup) -> Optional[List[str]]:
-    filters = {'data-testid': 'genres'}
-    try:
-        genres_raw = soup.find('div', filters).find_all('a')
-        return [el.text for el in genres_raw]
-    except Exception:
+def collect_genres(index: PageIndex) -> Optional[List[str]]:
+    nodes = index.get(GENRES_KEY)
+    if not nodes:
         return None
+    return [el.text_content() for el in NESTED_A_XPATH(nodes[0])]
 
 
-def collect_details_summary(soup: BeautifulSoup)\
+def collect_details_summary(index: PageIndex)\
         -> Dict[str, Union[List[str], str]]:
-    filters = {
-        'release_date':
-            {'data-testid': 'title-details-releasedate'},
-        'countries_of_origin':
-            {'data-testid': 'title-details-origin'},
-        'language':
-            {'data-testid': 'title-details-languages'},
-        'also_known_as':
-            {'data-testid': 'title-details-akas'},
-        'production_companies':
-            {'data-testid': 'title-details-companies'},
-        'filming_locations':
-            {'data-testid': 'title-details-filminglocations'}
-    }
     details = {}
-    for name, f in filters.items():
-        try:
-            raw_entity = soup.find('li', f).find_all('li')
-            entity = [entry.text for entry in raw_entity]
-        except Exception:
-            entity = None
-        details[name] = entity
+    for name, key in DETAILS_KEYS:
+        nodes = index.get(key)
+        details[name] = [
+            entry.text_content() for entry in NESTED_LI_XPATH(nodes[0])
+        ] if nodes else None
 
     # add runtime info
-    runtime_filter = {'data-testid': 'title-techspec_runtime'}
-    try:
-        runtime = soup.find('li', runtime_filter).div.text
-    except Exception:
-        runtime = None
-    details['runtime'] = runtime
+    nodes = index.get(RUNTIME_KEY)
+    runtime_divs = NESTED_DIV_XPATH(nodes[0]) if nodes else None
+    details['runtime'] = (
+        runtime_divs[0].text_content() if runtime_divs else None
+    )
 
     return details
 
 
-def collect_boxoffice(soup: BeautifulSoup) -> Optional[Dict[str, List[str]]]:
-    filters = {
-        'budget':
-            {'data-testid': 'title-boxoffice-budget'},
-        'boxoffice_gross_domestic':
-            {'data-testid': 'title-boxoffice-grossdomestic'},
-        'boxoffice_gross_opening':
-            {'data-testid': 'title-boxoffice-openingweekenddomestic'},
-        'boxoffice_gross_worldwide':
-            {'data-testid': 'title-boxoffice-cumulativeworldwidegross'}
-    }
+def collect_boxoffice(index: PageIndex) -> Optional[Dict[str, List[str]]]:
     boxoffice = dict()
-    for name, f in filters.items():
-        try:
-            entity = soup.find('li', f).li.text
-        except Exception:
-            entity = None
-        boxoffice[name] = entity
+    for name, key in BOXOFFICE_KEYS:
+        nodes = index.get(key)
+        entity_lis = NESTED_LI_XPATH(nodes[0]) if nodes else None
+        boxoffice[name] = entity_lis[0].text_content() if entity_lis else None
     return boxoffice
@@ -1,20 +1,26 @@
 import os
+import csv
+import asyncio
 import warnings
-import requests
-from time import sleep
 from pathlib import Path
-from typing import List, Dict, Any, Optional
-from pandas import DataFrame, read_json
+from typing import List, Dict, Tuple, Iterator, Any, Optional
+import orjson
+import fsspec
+from pandas import DataFrame
+from fsspec.core import url_to_fs
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from tqdm import tqdm
-from bs4 import BeautifulSoup
-from bs4.element import Tag
+from lxml import html, etree
 from dotenv import load_dotenv
-from recsys.utils import send_request, create_logger
+from recsys.utils import (create_logger, request_page, RateLimiter,
+                          REQUEST_HEADERS, REQUEST_TIMEOUT, BACKOFF_MAX_DELAY)
 
 warnings.filterwarnings('ignore')
 
 
 BAR_FORMAT = '{percentage:3.0f}%|{bar:20}{r_bar}'
+# number of titles after which collection status is saved to metadata file
+BATCH_SIZE = 50
 COLUMNS = [
     'title_id',
     'text',
@@ -37,6 +43,22 @@ LINK_URL_TEMPLATE = (
     'https://www.imdb.com{}reviews/_ajax/?sort=helpfulnessScore'
     '&dir=desc&ratingFilter=0'
 )
+HEADER_CLASS = 'header'
+REVIEW_CONTAINER_CLASS = 'review-container'
+LOAD_MORE_CLASS = 'load-more-data'
+# review pages are fed to the parser by chunks of this size, so review
+# containers are handled while the rest of a page is not parsed yet
+PAGE_CHUNK_SIZE = 64 * 1024
+# each part of a review is selected from its container by a single
+# precompiled query
+DATE_XPATH = etree.XPath('(.//span[@class="review-date"])[1]')
+TITLE_XPATH = etree.XPath('(.//a[@class="title"])[1]')
+TEXT_XPATH = etree.XPath('(.//div[@class="text show-more__control"])[1]')
+RATING_XPATH = etree.XPath('(.//span)[2]')
+AUTHOR_XPATH = etree.XPath(
+    '(.//span[@class="display-name-link"]//a)[1]/@href', smart_strings=False
+)
+HELPFULNESS_XPATH = etree.XPath('(.//div[@class="actions text-muted"])[1]')
 
 
 class ReviewCollector:
@@ -82,6 +104,11 @@ class ReviewCollector:
         server for a long period of time is not ethical and such requests could
         be rate limited as a result).
 
+        * concurrency: maximum number of titles collected at the same time.
+        Pages of one title are requested one after another, requests of all
+        titles share one rate limit: a new request is sent no sooner than
+        sleep_time seconds after the previous one.
+
         * log_file: file name to write logs related to collecting IDs.
 
         * log_level: minimal level of log messages.
@@ -99,6 +126,7 @@ class ReviewCollector:
         self._chunk_size = config['chunk_size']
         self._pct_reviews = config['pct_reviews']
         self._sleep_time = config['sleep_time']
+        self._concurrency = config['concurrency']
 
         if self._mode == 'cloud':
             load_dotenv()
@@ -139,19 +167,15 @@ class ReviewCollector:
         else:
             raise ValueError('Supported modes: "local", "cloud"')
 
-        metadata = read_json(
-            self._metadata_file,
-            storage_options=self._storage_options,
-            orient='index'
+        self._fs, _ = url_to_fs(
+            self._metadata_file, **(self._storage_options or {})
         )
-        if 'reviews_collected_flg' not in metadata.columns:
-            metadata['reviews_collected_flg'] = 0
-            metadata.to_json(
-                self._metadata_file,
-                storage_options=self._storage_options,
-                orient='index'
-            )
-        del metadata
+        # metadata is read once and kept in memory, collection status is
+        # updated in it and written back to the file
+        self._metadata = self._load_metadata()
+        if 'reviews_collected_flg' not in self._metadata.columns:
+            self._metadata['reviews_collected_flg'] = 0
+            self._write_metadata()
 
         self._logger = create_logger(
             filename=config['log_file'],
@@ -174,26 +198,24 @@ class ReviewCollector:
         self._logger.info('Successfully initialized ReviewCollector')
 
     @staticmethod
-    def collect_review(id_: str, tag: Tag) -> Dict[str, Any]:
+    def collect_review(id_: str, el: html.HtmlElement) -> Dict[str, Any]:
         return {
             'id': id_,
-            'text': collect_text(tag),
-            'rating': collect_rating(tag),
-            'date': collect_date(tag),
-            'title': collect_title(tag),
-            'author': collect_author(tag),
-            'helpfulness': collect_helpfulness(tag)
+            'text': collect_text(el),
+            'rating': collect_rating(el),
+            'date': collect_date(el),
+            'title': collect_title(el),
+            'author': collect_author(el),
+            'helpfulness': collect_helpfulness(el)
         }
 
     @staticmethod
-    def find_reviews_num(response: requests.Response) -> int:
-        bs = BeautifulSoup(response.text, 'lxml')
+    def find_reviews_num(header: html.HtmlElement) -> int:
         try:
             review_cnt = (
-                bs
-                .find('div', {'class', 'header'})
-                .find('div')
-                .text
+                header
+                .find('.//div')
+                .text_content()
                 .replace(' ', '')
                 .replace(',', '')
                 .split('Reviews')[0]
@@ -202,74 +224,63 @@ class ReviewCollector:
         except Exception:
             return 0
 
-    def collect_title_reviews(self, id_: str) -> List[Dict[str, Any]]:
-        request_params = {
-            'params': {
-                'ref_': 'undefined',
-                'paginationKey': ''
-            }
-        }
-
-        with requests.Session() as session:
-            session.headers['User-Agent'] = USER_AGENT
-            start_url = START_URL_TEMPLATE.format(id_)
+    async def collect_title_reviews(self, id_: str)\
+            -> Optional[List[Dict[str, Any]]]:
+        """
+        Collects reviews of a title page by page. None is returned if the
+        start page could not be requested, so the title is tried again on
+        the next run.
+        """
+        url = START_URL_TEMPLATE.format(id_)
+        params = None
+        title_reviews = []
+        reviews_num_max = None
+        while url:
             try:
-                res = send_request(start_url, session=session)
+                status, content = await request_page(
+                    self._session, url, self._limiter, self._logger, params
+                )
             except Exception as e:
-                self._logger.warn(
-                    f'Exception of sending start requests to ID {id_}'
-                    f' with message: {e}'
+                self._logger.warning(
+                    'Exception of sending request to ID %s'
+                    ' with message: %s', id_, e
                 )
+                status, content = None, b''
+            if status != 200 or not content:
+                self._logger.warning('Bad status code %s for %s', status, url)
+                return title_reviews if reviews_num_max is not None else None
 
-            reviews_num = ReviewCollector.find_reviews_num(res)
-            if self._n_reviews:
-                reviews_num_max = self._n_reviews
-            elif self._pct_reviews:
-                reviews_num_max = int(reviews_num * self._pct_reviews / 100)
-
-            title_reviews = []
-            load_another_reviews = True
-            while load_another_reviews:
-                sleep(self._sleep_time)
-
-                reviews_batch = []
-                soup = BeautifulSoup(res.text, 'lxml')
-                for tag in soup.select('.review-container'):
-                    review = ReviewCollector.collect_review(id_, tag)
-                    reviews_batch.append(review)
-
-                title_reviews.extend(reviews_batch)
-                self._logger.info(
-                    f'Collected {len(reviews_batch)} reviews'
-                    f' for title ID {id_}'
-                )
+            reviews_batch, pagination_key, reviews_num = parse_review_page(
+                id_, content
+            )
+            # the start page is parsed once, number of reviews is found
+            # in the same pass as reviews themselves
+            if reviews_num_max is None:
+                if self._n_reviews:
+                    reviews_num_max = self._n_reviews
+                elif self._pct_reviews:
+                    reviews_num_max = int(
+                        reviews_num * self._pct_reviews / 100
+                    )
 
-                if len(title_reviews) > reviews_num_max:
-                    break
+            title_reviews.extend(reviews_batch)
+            self._logger.info(
+                'Collected %d reviews for title ID %s',
+                len(reviews_batch), id_
+            )
 
-                # imitate clicking load-more button
-                try:
-                    pagination_key = (
-                        soup
-                        .select_one(".load-more-data[data-key]")
-                        .get("data-key")
-                    )
-                except AttributeError:
-                    load_another_reviews = False
-
-                if load_another_reviews:
-                    link_url = LINK_URL_TEMPLATE.format(id_)
-                    request_params['params']['paginationKey'] = pagination_key
-                    try:
-                        res = send_request(link_url, **request_params)
-                    except Exception as e:
-                        self._logger.warn(
-                            f'Exception of sending link requests to ID {id_}'
-                            f' with message: {e}'
-                        )
-
-            session.close()
-            res.close()
+            if len(title_reviews) > reviews_num_max:
+                break
+
+            # imitate clicking load-more button, the next page can be
+            # requested only after the key is found on the current one
+            url = None
+            if pagination_key is not None:
+                url = LINK_URL_TEMPLATE.format(id_)
+                params = {
+                    'ref_': 'undefined',
+                    'paginationKey': pagination_key
+                }
 
         return title_reviews
 
@@ -277,13 +288,7 @@ class ReviewCollector:
         """
         Checks if reviews were collected for all available titles.
         """
-        # As status file has only one column it must be read in columnar
-        # orientation
-        metadata = read_json(
-            self._metadata_file,
-            storage_options=self._storage_options,
-            orient='index'
-        )
+        metadata = self._metadata
         already_collected = metadata['reviews_collected_flg'].sum()
         total_movies = len(metadata)
 
@@ -293,111 +298,217 @@ class ReviewCollector:
         )
         return total_movies == already_collected
 
-    def collect(self) -> bool:
-        print('Collecting reviews...')
-
-        metadata = read_json(
-            self._metadata_file,
-            storage_options=self._storage_options,
-            orient='index'
-        )
+    async def _collect_titles(self, title_ids: Iterator[str],
+                              progress_bar: tqdm) -> None:
+        # every worker takes next title from the shared iterator, so each
+        # title is requested only once
+        for title_id in title_ids:
+            if self._session_counter >= self._chunk_size:
+                return
 
-        counter = 0
-        for title_id in tqdm(metadata.index, bar_format=BAR_FORMAT):
-            if metadata.at[title_id, 'reviews_collected_flg']:
+            title_reviews = await self.collect_title_reviews(title_id)
+            progress_bar.update()
+            if title_reviews is None:
                 continue
 
-            title_reviews = self.collect_title_reviews(title_id)
-
             # This line extracts pure title id from raw form
             # e.g. '/title/tt0468569/' -> 'tt0468569'
             id_ = title_id.split('/')[-2]
             title_path = os.path.join(self._review_folder, id_ + '.csv')
             try:
                 if len(title_reviews) > 0:
-                    DataFrame.from_records(title_reviews).to_csv(
-                        title_path,
-                        storage_options=self._storage_options
-                    )
-
-                # Update status on each iteration, because it takes a long
-                # time to parse reviews even for a single title.
-                metadata.at[title_id, 'reviews_collected_flg'] = 1
-                metadata.to_json(
-                    self._metadata_file,
-                    storage_options=self._storage_options,
-                    orient='index'
+                    self._save_reviews(title_reviews, title_path)
+            except Exception as e:
+                self._logger.warning(
+                    'Exception %s while collecting reviews about title %s',
+                    e, id_
                 )
+                continue
 
-                counter += 1
+            self._batch.append(title_id)
+            self._session_counter += 1
+            self._logger.info(
+                'Total collected %d reviews for title ID %s',
+                len(title_reviews), id_
+            )
 
-                self._logger.info(
-                    f'Total collected {len(title_reviews)} reviews '
-                    + f'for title ID {id_}'
-                )
-            except Exception as e:
-                self._logger.warn(
-                    f'Exception {str(e)} while collecting reviews'
-                    + f' about title {id_}'
-                )
+            # Status is saved every BATCH_SIZE titles rather than on
+            # each one, the whole metadata file is rewritten each time.
+            # Workers share one event loop and saving does not yield to
+            # it, so the file is never written by two workers at once.
+            if len(self._batch) == BATCH_SIZE:
+                self._save_metadata()
+
+    async def _collect_async(self) -> None:
+        metadata = self._metadata
+        # titles with collected reviews are filtered out once, so progress
+        # bar shows only the remaining work
+        title_ids = metadata.index[
+            metadata['reviews_collected_flg'] == 0
+        ].tolist()
+
+        self._session_counter = 0
+        # titles collected since the last save of metadata
+        self._batch = []
+        # requests of all workers are spaced by sleep_time seconds
+        self._limiter = RateLimiter(max_rate=1, time_period=self._sleep_time)
+        # Idle connections are kept alive longer than the longest backoff
+        # pause, so TLS handshakes are not repeated after rate limiting.
+        connector = TCPConnector(
+            limit_per_host=self._concurrency,
+            keepalive_timeout=BACKOFF_MAX_DELAY + self._sleep_time,
+            ttl_dns_cache=None
+        )
+        session_params = {
+            'connector': connector,
+            'headers': {**REQUEST_HEADERS, 'User-Agent': USER_AGENT},
+            'timeout': ClientTimeout(total=REQUEST_TIMEOUT)
+        }
+        title_ids_iter = iter(title_ids)
+        progress_bar = tqdm(total=len(title_ids), bar_format=BAR_FORMAT)
+        try:
+            with progress_bar:
+                async with ClientSession(**session_params) as self._session:
+                    await asyncio.gather(*[
+                        self._collect_titles(title_ids_iter, progress_bar)
+                        for _ in range(self._concurrency)
+                    ])
+        finally:
+            # status of titles collected since the last batch is saved
+            # even if collecting was interrupted
+            if self._batch:
+                self._save_metadata()
+
+        if self._session_counter >= self._chunk_size:
+            self._logger.info('Stop parsing due to requests limit')
+
+    def collect(self) -> None:
+        """
+        Parses review pages of titles and saves reviews on a disk or cloud.
+        Titles are collected concurrently, at most "concurrency" titles at
+        a time.
+        """
+        print('Collecting reviews...')
 
-            if counter == self._chunk_size:
-                self._logger.info('Stop parsing due to requests limit')
-                return
+        asyncio.run(self._collect_async())
 
+    def _load_metadata(self) -> DataFrame:
+        # orjson parses the file several times faster than read_json
+        with self._fs.open(self._metadata_file, 'rb') as metadata_file:
+            return DataFrame.from_dict(
+                orjson.loads(metadata_file.read()), orient='index'
+            )
 
-def collect_date(tag: Tag) -> Optional[str]:
-    filters = {'class': 'review-date'}
-    try:
-        date_raw = tag.find('span', filters)
-        return date_raw.text
-    except Exception:
-        return None
+    def _save_reviews(self, title_reviews: List[Dict[str, Any]],
+                      path: str) -> None:
+        """
+        Writes reviews in the same layout as DataFrame.to_csv does: the first
+        unnamed column holds row numbers.
+        """
+        with fsspec.open(path, 'w', newline='',
+                         **(self._storage_options or {})) as fp:
+            writer = csv.writer(fp, lineterminator='\n')
+            writer.writerow(['', *title_reviews[0]])
+            writer.writerows(
+                [row_num, *review.values()]
+                for row_num, review in enumerate(title_reviews)
+            )
 
+    def _save_metadata(self) -> None:
+        self._metadata.loc[self._batch, 'reviews_collected_flg'] = 1
+        self._batch = []
+        self._write_metadata()
+        self._logger.info('Saved collection status of reviews')
 
-def collect_title(tag: Tag) -> Optional[str]:
-    filters = {'class': 'title'}
-    try:
-        title_raw = tag.find('a', filters)
-        return title_raw.text
-    except Exception:
-        return None
+    def _write_metadata(self) -> None:
+        """
+        Writes metadata to a temporary file which then replaces the metadata
+        file, so an interrupted write does not leave it truncated.
+        """
+        tmp_file = f'{self._metadata_file}.tmp'
+        self._metadata.to_json(
+            tmp_file,
+            storage_options=self._storage_options,
+            orient='index'
+        )
+        self._fs.mv(tmp_file, self._metadata_file)
 
 
-def collect_text(tag: Tag) -> Optional[str]:
-    filters = {'class': 'text show-more__control'}
-    try:
-        text_raw = tag.find('div', filters)
-        return text_raw.text
-    except Exception:
-        return None
+def iter_review_page(page: bytes) -> Iterator[html.HtmlElement]:
+    """
+    Parses a page incrementally and yields its div elements as soon as
+    they are closed.
+    """
+    parser = etree.HTMLPullParser(events=('end',), tag='div', encoding='utf-8')
+    parser.set_element_class_lookup(html.HtmlElementClassLookup())
+    for start in range(0, len(page), PAGE_CHUNK_SIZE):
+        parser.feed(page[start:start + PAGE_CHUNK_SIZE])
+        for _, el in parser.read_events():
+            yield el
+    parser.close()
+    for _, el in parser.read_events():
+        yield el
+
+
+def parse_review_page(id_: str, page: bytes)\
+        -> Tuple[List[Dict[str, Any]], Optional[str], int]:
+    """
+    Collects reviews from a page together with the key of the next page,
+    which is None on the last page, and the total number of reviews, which
+    is 0 if the page has no header. Review containers are dropped as soon
+    as their reviews are collected, so the whole page tree is not kept.
+    """
+    reviews = []
+    pagination_key = None
+    reviews_num = 0
+    header_found = False
+    for el in iter_review_page(page):
+        classes = el.get('class', '').split()
+        if REVIEW_CONTAINER_CLASS in classes:
+            reviews.append(ReviewCollector.collect_review(id_, el))
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+        elif LOAD_MORE_CLASS in classes and el.get('data-key') is not None:
+            pagination_key = el.get('data-key')
+        elif HEADER_CLASS in classes and not header_found:
+            # only the first header holds the number of reviews
+            reviews_num = ReviewCollector.find_reviews_num(el)
+            header_found = True
+    return reviews, pagination_key, reviews_num
+
+
+def get_text(nodes: List[html.HtmlElement]) -> Optional[str]:
+    return nodes[0].text_content() if nodes else None
+
+
+def collect_date(el: html.HtmlElement) -> Optional[str]:
+    return get_text(DATE_XPATH(el))
 
 
-def collect_rating(tag: Tag) -> Optional[float]:
+def collect_title(el: html.HtmlElement) -> Optional[str]:
+    return get_text(TITLE_XPATH(el))
+
+
+def collect_text(el: html.HtmlElement) -> Optional[str]:
+    return get_text(TEXT_XPATH(el))
+
+
+def collect_rating(el: html.HtmlElement) -> Optional[float]:
+    rating = get_text(RATING_XPATH(el))
+    # If no rating was given, span block containes review date
+    if rating is None or len(rating) > 2:
+        return None
     try:
-        rating_raw = tag.find_all('span')
-        rating = rating_raw[1].text
-        # If no rating was given, span block containes review date
-        if len(rating) > 2:
-            return None
         return int(rating)
-    except Exception:
+    except ValueError:
         return None
 
 
-def collect_author(tag: Tag) -> Optional[str]:
-    filters = {'class': 'display-name-link'}
-    try:
-        author_raw = tag.find('span', filters)
-        return author_raw.a['href']
-    except Exception:
-        return None
+def collect_author(el: html.HtmlElement) -> Optional[str]:
+    hrefs = AUTHOR_XPATH(el)
+    return hrefs[0] if hrefs else None
 
 
-def collect_helpfulness(tag: Tag) -> Optional[str]:
-    filters = {'class': 'actions text-muted'}
-    try:
-        helpfulness_raw = tag.find('div', filters)
-        return helpfulness_raw.text
-    except Exception:
-        return None
+def collect_helpfulness(el: html.HtmlElement) -> Optional[str]:
+    return get_text(HELPFULNESS_XPATH(el))
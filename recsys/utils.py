@@ -1,14 +1,22 @@
 import os
 import io
+import time
+import asyncio
 import dill
+import random
 import yaml
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from io import BytesIO
 from PIL import Image
 from logging import Logger, basicConfig, getLogger
-from typing import Dict, Any
+from typing import Dict, Tuple, Any, Optional
+from aiohttp import ClientSession, ClientResponse, ClientError
 from tenacity import (retry, wait_random,
                       stop_after_attempt,
                       retry_if_exception_type)
@@ -19,6 +27,17 @@ ROOT_PATH = os.path.abspath(os.path.join(DIR_PATH, '..'))
 RETRY_ATTEMPTS = 5
 RETRY_MIN_DELAY = 1
 RETRY_MAX_DELAY = 2
+REQUEST_HEADERS = {'Accept-Language': 'en-US,en;q=0.5'}
+# status codes of rate limiting and temporary unavailability, the request
+# should be repeated after a pause
+RETRY_STATUS_CODES = (429, 503)
+BACKOFF_BASE_DELAY = 1
+BACKOFF_MAX_DELAY = 60
+REQUEST_TIMEOUT = 30
+POOL_MAXSIZE = 32
+# IMDB pages are under 2 MB, the limit leaves a margin above that, so only
+# responses of more than 5 MB are not read to the end
+MAX_PAGE_SIZE = 5_000_000
 
 
 @dataclass
@@ -27,6 +46,69 @@ class SaveResponse:
     exception_msg: str = ''
 
 
+class RateLimiter:
+    """
+    Token bucket shared by asynchronous workers. No more than max_rate
+    requests are allowed within time_period seconds, no matter how many
+    workers send them.
+    """
+    def __init__(self, max_rate: float, time_period: float = 1.):
+        self._max_rate = max_rate
+        self._time_period = time_period
+        self._tokens = max_rate
+        self._last_update = time.monotonic()
+        # workers get tokens in order they asked for them
+        self._lock = asyncio.Lock()
+        # no tokens are given out before this moment, pauses overlapping in
+        # time end with the latest of them
+        self._paused_until = 0.
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self._max_rate,
+            self._tokens + (now - self._last_update)
+            * self._max_rate / self._time_period
+        )
+        self._last_update = now
+
+    async def _wait_pause(self) -> None:
+        # a pause may be extended while the worker sleeps
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def acquire(self) -> None:
+        await self._wait_pause()
+        if self._time_period <= 0:
+            return
+        async with self._lock:
+            # a pause may start while the worker waits for its turn
+            await self._wait_pause()
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep(
+                    (1 - self._tokens) * self._time_period / self._max_rate
+                )
+                self._refill()
+            self._tokens -= 1
+
+    async def pause(self, delay: float) -> None:
+        """
+        Stops giving out tokens to all workers for delay seconds. A shorter
+        pause does not cut a longer one which is already going on.
+        """
+        self._paused_until = max(
+            self._paused_until, time.monotonic() + delay
+        )
+        await self._wait_pause()
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
 def get_full_path(dirname_or_filename: str, filename: str = None) -> str:
     path_norm = os.path.normpath(dirname_or_filename)
     path_tokens = path_norm.split(os.sep)
@@ -53,8 +135,10 @@ def write_json(obj: Dict[Any, Any], path: str):
     if dirname and not os.path.exists(dirname):
         raise OSError(f'Directory {dirname} does not exist')
 
-    with open(path, 'w') as fp:
-        json.dump(obj, fp)
+    # orjson encodes straight to bytes, keys which are not strings are
+    # converted the same way as json.dump does
+    with open(path, 'wb') as fp:
+        fp.write(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS))
 
 
 def read_json(path: str) -> Dict[Any, Any]:
@@ -62,10 +146,8 @@ def read_json(path: str) -> Dict[Any, Any]:
     if dirname and not os.path.exists(dirname):
         raise OSError(f'Directory {dirname} does not exist')
 
-    data = None
-    with open(path, 'r') as fp:
-        data = json.load(fp)
-    return data
+    with open(path, 'rb') as fp:
+        return orjson.loads(fp.read())
 
 
 def write_bytest_to_image(img_bytes: bytes, path: str,
@@ -98,6 +180,33 @@ def create_logger(filename: str, msg_format: str, dt_format: str, level: str)\
     return getLogger('')
 
 
+def create_session() -> requests.Session:
+    """
+    Creates a session which keeps connections alive between requests and
+    repeats requests responded with rate limiting status codes.
+    """
+    session = requests.Session()
+    session.headers.update(REQUEST_HEADERS)
+    adapter = HTTPAdapter(
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=Retry(
+            total=RETRY_ATTEMPTS,
+            connect=0,
+            read=0,
+            backoff_factor=BACKOFF_BASE_DELAY,
+            status_forcelist=RETRY_STATUS_CODES,
+            raise_on_status=False
+        )
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# all requests without explicitly given session share connections
+SESSION = create_session()
+
+
 @retry(
     retry=retry_if_exception_type((
         requests.ConnectionError, requests.Timeout
@@ -107,10 +216,102 @@ def create_logger(filename: str, msg_format: str, dt_format: str, level: str)\
 )
 def send_request(url: str, session: requests.Session = None,
                  **request_params) -> requests.Response:
-    headers = {"Accept-Language": "en-US,en;q=0.5"}
+    request_params.setdefault('timeout', REQUEST_TIMEOUT)
     if session:
-        return session.get(url, headers=headers, **request_params)
-    return requests.get(url, headers=headers, **request_params)
+        return session.get(url, headers=REQUEST_HEADERS, **request_params)
+    return SESSION.get(url, **request_params)
+
+
+def get_retry_delay(attempt: int, retry_after: Optional[str] = None)\
+        -> float:
+    """
+    Returns time in seconds to wait before the next attempt of a request.
+    The delay from Retry-After header (in seconds or as HTTP date) is used
+    if it is given, otherwise exponential backoff with jitter is applied.
+    """
+    if retry_after:
+        try:
+            return max(0., float(retry_after))
+        except ValueError:
+            pass
+        try:
+            retry_dt = parsedate_to_datetime(retry_after)
+            return max(0., (retry_dt - datetime.now(timezone.utc))
+                       .total_seconds())
+        except (TypeError, ValueError):
+            pass
+    delay = min(BACKOFF_MAX_DELAY, BACKOFF_BASE_DELAY * 2 ** attempt)
+    return delay * random.uniform(0.5, 1.5)
+
+
+async def read_content(response: ClientResponse, max_size: int)\
+        -> Optional[bytes]:
+    """
+    Reads response body as it arrives. None is returned as soon as the body
+    turns out to be longer than max_size bytes.
+    """
+    if (response.content_length or 0) > max_size:
+        return None
+    chunks = []
+    size = 0
+    async for chunk in response.content.iter_any():
+        size += len(chunk)
+        if size > max_size:
+            return None
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+async def request_page(session: ClientSession, url: str,
+                       limiter: RateLimiter, logger: Logger,
+                       params: Optional[Dict[str, str]] = None)\
+        -> Tuple[int, bytes]:
+    """
+    Requests a page with optional query params and returns its status code
+    and content. Content is read only from successful responses not larger
+    than MAX_PAGE_SIZE bytes, otherwise it is empty. Pages responded with
+    429 or 503 status code or failed with a connection error or timeout are
+    requested again after a pause. While one worker waits, the others
+    sharing the same limiter do not send requests.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        await limiter.acquire()
+        try:
+            async with session.get(url, params=params) as response:
+                if response.status == 200:
+                    content = await read_content(response, MAX_PAGE_SIZE)
+                    if content is None:
+                        logger.warning(
+                            'Page %s is larger than %d bytes, skipped',
+                            url, MAX_PAGE_SIZE
+                        )
+                        return response.status, b''
+                    return response.status, content
+                if response.status not in RETRY_STATUS_CODES\
+                        or attempt == RETRY_ATTEMPTS - 1:
+                    return response.status, b''
+                # short error page is read out, so its connection can be
+                # reused for the next attempt
+                await response.read()
+        except (ClientError, asyncio.TimeoutError) as e:
+            # connection errors are repeated as well, the last one is
+            # passed to the caller
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise
+            delay = get_retry_delay(attempt)
+            logger.warning(
+                'Exception %r for %s, next attempt in %.1f seconds',
+                e, url, delay
+            )
+            await limiter.pause(delay)
+            continue
+
+        delay = get_retry_delay(attempt, response.headers.get('Retry-After'))
+        logger.warning(
+            'Status code %d for %s, next attempt in %.1f seconds',
+            response.status, url, delay
+        )
+        await limiter.pause(delay)
 
 
 def check_health_status(url: str) -> bool:
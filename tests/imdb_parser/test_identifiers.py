@@ -1,5 +1,5 @@
 import os
-import bs4 as bs
+import json
 from recsys.utils import load_obj
 from recsys.imdb_parser.identifiers import IDCollector
 
@@ -10,7 +10,7 @@ IDENTIFIERS_PAGE_PATH = os.path.join(FILE_DIR, '..', 'data',
 
 def test_collect_movie_id():
     page = load_obj(IDENTIFIERS_PAGE_PATH)
-    ids = IDCollector.collect_movie_id(bs.BeautifulSoup(page, 'lxml'))
+    ids = IDCollector.collect_movie_id(page)
     some_items = (
         ('/title/tt7991608/', {'main_genre': 'Action'}),
         ('/title/tt10872600/', {'main_genre': 'Action'}),
@@ -18,3 +18,51 @@ def test_collect_movie_id():
     )
     assert len(ids) == 50
     assert all([item in list(ids.items()) for item in some_items])
+
+
+def test_collect_resumes_from_checkpoint(tmp_path):
+    config = {
+        'mode': 'local',
+        'metadata_file': str(tmp_path / 'metadata.json'),
+        'genres': ['war'],
+        'n_titles': 150,
+        'pct_titles': None,
+        'sleep_time': 0,
+        'concurrency': 1,
+        'verbose': False,
+        'checkpoint_dir': 'data/checkpoints/tests',
+        'log_file': 'logs/imdb_parser/tests.log',
+        'log_level': 'INFO',
+        'log_msg_format': '%(asctime)s %(levelname)s %(message)s',
+        'log_dt_format': '%Y-%m-%d %H:%M:%S'
+    }
+    collector = IDCollector(config)
+    collector._checkpoint_dir = str(tmp_path / 'checkpoints')
+    os.makedirs(collector._checkpoint_dir)
+    collector._save_checkpoint(
+        'war', 1, {'/title/tt0000001/': {'main_genre': 'War'}}
+    )
+    collector._save_checkpoint(
+        'war', 51, {'/title/tt0000051/': {'main_genre': 'Drama'}}
+    )
+    # record of the third page was cut off by interruption
+    with open(collector._get_checkpoint_path('war'), 'ab') as checkpoint:
+        checkpoint.write(b'{"rank":101,"ids":{"/title/tt00')
+
+    requested_ranks = []
+
+    async def collect_rank_id(genre, rank):
+        requested_ranks.append(rank)
+        return {'/title/tt0000101/': {'main_genre': 'War'}}
+
+    collector._collect_rank_id = collect_rank_id
+    collector.collect()
+
+    assert requested_ranks == [101]
+    with open(config['metadata_file'], 'rb') as output:
+        assert json.loads(output.read()) == {
+            '/title/tt0000001/': {'main_genre': 'War'},
+            '/title/tt0000051/': {'main_genre': 'Drama'},
+            '/title/tt0000101/': {'main_genre': 'War'}
+        }
+    assert not os.path.exists(collector._get_checkpoint_path('war'))
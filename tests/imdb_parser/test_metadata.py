@@ -1,6 +1,6 @@
 import os
 import pytest
-from bs4 import BeautifulSoup
+from lxml import html
 from recsys.utils import send_request
 from recsys.imdb_parser import metadata
 
@@ -12,9 +12,10 @@ EXAMPLE_URL = 'https://www.imdb.com/title/tt7991608/'
 
 
 @pytest.fixture
-def page() -> BeautifulSoup:
+def page() -> metadata.PageIndex:
     page = send_request(EXAMPLE_URL)
-    return BeautifulSoup(page.text, 'lxml')
+    tree = html.fromstring(page.content, parser=metadata.HTML_PARSER)
+    return metadata.index_page(tree)
 
 
 def test_collect_original_title(page):
@@ -59,6 +60,24 @@ def test_collect_imdb_recommendations(page):
     assert '1' in recommendations
 
 
+def test_collect_links_without_rank():
+    tree = html.fromstring(
+        '<div>'
+        '<a data-testid="title-cast-item__actor"'
+        ' href="/name/nm0425005/?ref_=tt_cl_t_1">A</a>'
+        '<a data-testid="title-cast-item__actor" href="/name/nm0000001/">B</a>'
+        '<a class="ipc-poster-card__title"'
+        ' href="/title/tt1345836/?ref_=tt_sims_tt_t_1">C</a>'
+        '<a class="ipc-poster-card__title" href="/title/tt1375666/">D</a>'
+        '</div>'
+    )
+    index = metadata.index_page(tree)
+    assert metadata.collect_actors(index) == {'1': '/name/nm0425005/'}
+    assert metadata.collect_imdb_recommendations(index) == {
+        '1': '/title/tt1345836/'
+    }
+
+
 def test_collect_genres(page):
     genres = metadata.collect_genres(page)
     true_genres = {'Action', 'Adventure', 'Comedy'}
@@ -85,3 +104,44 @@ def test_collect_boxoffice(page):
     assert boxoffice is not None
     assert 'budget' in boxoffice.keys()
     assert boxoffice['budget'] == '$160,000,000 (estimated)'
+
+
+def test_batches_are_merged_into_metadata(tmp_path):
+    config = {
+        'mode': 'local',
+        'metadata_file': str(tmp_path / 'metadata.json'),
+        'chunk_size': 10,
+        'sleep_time': 0,
+        'concurrency': 1,
+        'log_file': 'logs/imdb_parser/tests.log',
+        'log_level': 'INFO',
+        'log_msg_format': '%(asctime)s %(levelname)s %(message)s',
+        'log_dt_format': '%Y-%m-%d %H:%M:%S'
+    }
+    collector = metadata.MetadataCollector(config)
+    collector._part_num = 0
+    collector._batch = {'/title/tt0000001/': {'original_title': 'First'}}
+    collector._save_batch()
+    collector._batch = {
+        '/title/tt0000002/': {'original_title': 'Second', 'genres': ['War']}
+    }
+    collector._save_batch()
+
+    # batches are restored by the next run into freshly loaded metadata
+    collector._movie_metadata = {
+        '/title/tt0000001/': {'main_genre': 'Drama'},
+        '/title/tt0000002/': {'main_genre': 'War'},
+        '/title/tt0000003/': {'main_genre': 'Comedy'}
+    }
+    collector._load_batches()
+
+    assert collector._part_num == 2
+    assert collector._movie_metadata == {
+        '/title/tt0000001/': {
+            'main_genre': 'Drama', 'original_title': 'First'
+        },
+        '/title/tt0000002/': {
+            'main_genre': 'War', 'original_title': 'Second', 'genres': ['War']
+        },
+        '/title/tt0000003/': {'main_genre': 'Comedy'}
+    }
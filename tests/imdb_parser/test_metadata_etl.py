@@ -67,6 +67,27 @@ def test_normalize(movie_details):
            & (actors.loc[0, 3] == '/name/nm0685284')
 
 
+def test_normalize_empty_dicts():
+    details = pd.DataFrame({'actors': [{}, {}, {}]})
+    actors = etl.normalize(details, 'actors')
+
+    assert len(actors) == 3
+
+
+def test_parse_recommendations_without_rank():
+    recomms_raw = {
+        'title_id': 1,
+        'imdb_recommendations': [
+            '/title/tt1345836/?ref_=tt_sims_tt_t_1',
+            '/title/tt1375666/'
+        ]
+    }
+    recomms_parsed = etl.parse_recommendations(recomms_raw).to_pydict()
+    assert recomms_parsed['suggested_title_id'] == ['/title/tt1345836/',
+                                                    '/title/tt1375666/']
+    assert recomms_parsed['order_num'] == [1, None]
+
+
 def test_review_summary(movie_details):
     summary = etl.split_review_summary(movie_details)
 
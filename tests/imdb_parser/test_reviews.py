@@ -1,7 +1,9 @@
 import os
 import pytest
-from bs4 import BeautifulSoup
+import pandas as pd
+from lxml import html
 from recsys.utils import load_obj
+from recsys.imdb_parser import reviews
 from recsys.imdb_parser.reviews import ReviewCollector
 
 FILE_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -9,12 +11,20 @@ REVIEW_TAG_PATH = os.path.join(
     FILE_DIR, '..', 'data', 'review_tag_example.pkl'
 )
 REVIEW_ID = '/title/tt0068646/'
+REVIEW_PAGE_TEMPLATE = (
+    '<html><body>'
+    '<div class="header"><div>1,234 Reviews</div></div>'
+    '<div class="lister-list">{}</div>'
+    '<div class="load-more-data" data-key="g4xolermtiqhejcxxxgs753i36t52q">'
+    '</div>'
+    '</body></html>'
+)
 
 
 @pytest.fixture
 def review():
-    review_soup = BeautifulSoup(load_obj(REVIEW_TAG_PATH), 'lxml')
-    return ReviewCollector.collect_review(REVIEW_ID, review_soup)
+    review_tag = html.fromstring(load_obj(REVIEW_TAG_PATH))
+    return ReviewCollector.collect_review(REVIEW_ID, review_tag)
 
 
 def test_rc_review_parsing(review):
@@ -60,3 +70,77 @@ def test_rc_collect_title(review):
         .replace(' ', '')
     )
     assert review_title_strip == true_title_strip
+
+
+@pytest.mark.parametrize('chunk_size', [7, 1000, reviews.PAGE_CHUNK_SIZE])
+def test_parse_review_page(monkeypatch, chunk_size):
+    # small chunks cut review containers and the load-more element apart
+    monkeypatch.setattr(reviews, 'PAGE_CHUNK_SIZE', chunk_size)
+    review_tag = load_obj(REVIEW_TAG_PATH)
+    page = REVIEW_PAGE_TEMPLATE.format(review_tag * 3).encode()
+
+    page_reviews, pagination_key, reviews_num = reviews.parse_review_page(
+        REVIEW_ID, page
+    )
+    review = ReviewCollector.collect_review(
+        REVIEW_ID, html.fromstring(review_tag)
+    )
+    assert page_reviews == [review] * 3
+    assert pagination_key == 'g4xolermtiqhejcxxxgs753i36t52q'
+    assert reviews_num == 1234
+
+
+def test_save_reviews(tmp_path):
+    metadata_file = tmp_path / 'metadata.json'
+    metadata_file.write_text(
+        '{"/title/tt0068646/": {"main_genre": "Crime"}}'
+    )
+    config = {
+        'mode': 'local',
+        'metadata_file': str(metadata_file),
+        'n_reviews': 10,
+        'pct_reviews': None,
+        'chunk_size': 10,
+        'sleep_time': 0,
+        'concurrency': 1,
+        'log_file': 'logs/imdb_parser/tests.log',
+        'log_level': 'INFO',
+        'log_msg_format': '%(asctime)s %(levelname)s %(message)s',
+        'log_dt_format': '%Y-%m-%d %H:%M:%S'
+    }
+    collector = ReviewCollector(config)
+    title_reviews = [
+        {
+            'id': REVIEW_ID,
+            'text': 'Quotes "inside", commas, and\nline breaks',
+            'rating': 10,
+            'date': '\n    30 March 2013\n   ',
+            'title': 'A masterpiece\n',
+            'author': '/user/ur0000001/?ref_=tt_urv',
+            'helpfulness': '\n 1,710 out of 1,850 found this helpful.\n'
+        },
+        {
+            'id': REVIEW_ID,
+            'text': 'No rating',
+            'rating': None,
+            'date': '1 April 2013',
+            'title': 'Title',
+            'author': None,
+            'helpfulness': None
+        }
+    ]
+    path = str(tmp_path / 'tt0068646.csv')
+    collector._save_reviews(title_reviews, path)
+
+    # the file is read back the same way as one written by DataFrame.to_csv
+    expected_path = str(tmp_path / 'expected.csv')
+    pd.DataFrame(title_reviews).to_csv(expected_path)
+    saved_reviews = pd.read_csv(path)
+    assert list(saved_reviews.columns) == [
+        'Unnamed: 0', 'id', 'text', 'rating', 'date', 'title', 'author',
+        'helpfulness'
+    ]
+    assert list(saved_reviews['Unnamed: 0']) == [0, 1]
+    pd.testing.assert_frame_equal(
+        pd.read_csv(path, index_col=0), pd.read_csv(expected_path, index_col=0)
+    )
@@ -1,42 +1,37 @@
 from datetime import datetime
-import pytest
 import pandas as pd
 from recsys.imdb_parser import etl
 
 
-@pytest.fixture
-def reviews():
-    data = [
+def test_transform():
+    raw_reviews = pd.DataFrame([
         {
-            'id': 1,
-            'helpfulness': '\n 171 out of 185 found this helpful.\n',
-            'date': '31 January 2020'
+            'Unnamed: 0': 0,
+            'id': '/title/tt0068646/',
+            'rating': 10,
+            'date': '\n    30 March 2013\n   ',
+            'title': 'A masterpiece\n',
+            'author': '/user/ur0000001/?ref_=tt_urv',
+            'helpfulness': '\n 1,710 out of 1,850 found this helpful.\n'
         },
         {
-            'id': 2,
-            'helpfulness': '\n 1,710 out of 1,850 found this helpful.\n',
-            'date': '31 January 2021'
+            'Unnamed: 0': 1,
+            'id': '/title/tt0068646/',
+            'rating': 9,
+            'date': '\n    31 January 2020\n   ',
+            'title': 'Popular review\n',
+            'author': '/user/ur0000002/?ref_=tt_urv',
+            'helpfulness': '\n 40,171 out of 41,185 found this helpful.\n'
         }
-    ]
-    return pd.DataFrame(data)
-
-
-def test_split_helpfulness_col(reviews):
-    df_ = etl.split_helpfulness_col(reviews)
-
-    assert ('upvotes' in df_.columns) and ('total_votes' in df_.columns)
-    assert 'helpfulness' not in df_.columns
-    assert (df_.loc[0, 'upvotes'] == 171
-            and df_.loc[0, 'total_votes'] == 185)
-    assert (df_.loc[1, 'upvotes'] == 1710
-            and df_.loc[1, 'total_votes'] == 1850)
-
-
-def test_convert_to_date(reviews):
-    df_ = etl.convert_to_date(reviews)
-
-    assert 'review_date' in df_.columns
-    assert 'date' not in df_.columns
-    assert df_.loc[0, 'review_date'] == datetime(2020, 1, 31).date()
-
-
+    ])
+    df_ = etl.ReviewsETL.transform(raw_reviews)
+
+    assert all(c not in df_.columns
+               for c in ['Unnamed: 0', 'helpfulness', 'date'])
+    assert df_.loc[0, 'author'] == '/user/ur0000001/'
+    assert df_.loc[0, 'title'] == 'A masterpiece'
+    assert (df_.loc[0, 'upvotes'] == 1710
+            and df_.loc[0, 'total_votes'] == 1850)
+    assert df_.loc[0, 'review_date'] == datetime(2013, 3, 30)
+    assert (df_.loc[1, 'upvotes'] == 40171
+            and df_.loc[1, 'total_votes'] == 41185)
@@ -0,0 +1,55 @@
+import asyncio
+import time
+from recsys.utils import RateLimiter
+
+
+def test_tokens_are_spaced():
+    async def run():
+        limiter = RateLimiter(max_rate=1, time_period=0.1)
+        start = time.monotonic()
+        for _ in range(3):
+            await limiter.acquire()
+        return time.monotonic() - start
+
+    # the first token is given at once, the others in 0.1 second each
+    assert 0.2 <= asyncio.run(run()) < 0.5
+
+
+def test_pause_blocks_acquire():
+    async def run():
+        limiter = RateLimiter(max_rate=1, time_period=0.01)
+        start = time.monotonic()
+
+        async def acquire_later():
+            await asyncio.sleep(0.05)
+            await limiter.acquire()
+            return time.monotonic() - start
+
+        _, waited = await asyncio.gather(
+            limiter.pause(0.2), acquire_later()
+        )
+        return waited
+
+    assert asyncio.run(run()) >= 0.2
+
+
+def test_shorter_pause_does_not_cut_longer_one():
+    async def run():
+        limiter = RateLimiter(max_rate=1, time_period=0.01)
+        start = time.monotonic()
+
+        async def acquire_later():
+            await asyncio.sleep(0.1)
+            await limiter.acquire()
+            return time.monotonic() - start
+
+        async def pause_later():
+            await asyncio.sleep(0.05)
+            await limiter.pause(0.1)
+
+        _, _, waited = await asyncio.gather(
+            limiter.pause(0.5), pause_later(), acquire_later()
+        )
+        return waited
+
+    assert asyncio.run(run()) >= 0.5
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from aiohttp import web, ClientSession
+from aiohttp.test_utils import TestServer
+from recsys import utils
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+async def fetch(handler, params=None):
+    app = web.Application()
+    app.router.add_get('/', handler)
+    async with TestServer(app) as server, ClientSession() as session:
+        limiter = utils.RateLimiter(max_rate=100)
+        return await utils.request_page(
+            session, str(server.make_url('/')), limiter, LOGGER, params
+        )
+
+
+def test_request_page_retries_connection_errors(monkeypatch):
+    monkeypatch.setattr(utils, 'get_retry_delay', lambda *args: 0.)
+    attempts = []
+
+    async def handler(request):
+        attempts.append(request)
+        # aiohttp itself repeats a request once if the connection is dropped
+        # without response, so it is dropped twice
+        if len(attempts) <= 2:
+            request.transport.close()
+        return web.Response(body=b'page')
+
+    assert asyncio.run(fetch(handler)) == (200, b'page')
+    assert len(attempts) == 3
+
+
+def test_request_page_skips_large_page(monkeypatch):
+    monkeypatch.setattr(utils, 'MAX_PAGE_SIZE', 10)
+
+    async def handler(request):
+        return web.Response(body=b'x' * 11)
+
+    assert asyncio.run(fetch(handler)) == (200, b'')
+
+
+def test_request_page_skips_large_page_without_length(monkeypatch):
+    monkeypatch.setattr(utils, 'MAX_PAGE_SIZE', 10)
+
+    async def handler(request):
+        # chunked response, its size is known only after it is read
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for _ in range(3):
+            await response.write(b'x' * 5)
+        await response.write_eof()
+        return response
+
+    assert asyncio.run(fetch(handler)) == (200, b'')
+
+
+def test_get_retry_delay_seconds():
+    assert utils.get_retry_delay(0, '5') == 5.
+
+
+def test_get_retry_delay_http_date():
+    retry_dt = datetime.now(timezone.utc) + timedelta(seconds=30)
+    delay = utils.get_retry_delay(0, format_datetime(retry_dt, usegmt=True))
+    assert 28 <= delay <= 30
+
+
+def test_get_retry_delay_garbage():
+    # exponential backoff with jitter is used instead
+    delay = utils.get_retry_delay(2, 'soon')
+    assert 2 <= delay <= 6